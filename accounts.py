@@ -0,0 +1,98 @@
+"""Pool of Clubhouse accounts stored in the `accounts` collection.
+
+Each account gets its own rate-limited client and a health score. An account
+that gets a ban-style answer is quarantined for a while, and the quarantine
+doubles with every strike. Once a quarantine is over the account is tried again
+on probation: one success clears its strikes, one more ban answer sends it back
+for twice as long.
+"""
+
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+
+from pymongo import DESCENDING, ReturnDocument
+
+from clubhouse import Clubhouse
+
+from chclient import ClubhouseClient
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+
+def add_account(collection, user_id, user_token, user_device):
+    collection.update_one({'_id': str(user_id)},
+                          {'$set': {'user_token': user_token,
+                                    'user_device': user_device,
+                                    'health': 1.0,
+                                    'strikes': 0,
+                                    'quarantined_until': None},
+                           '$setOnInsert': {'added': datetime.now(timezone.utc)}},
+                          upsert=True)
+    logger.info(f'Account {user_id} is in the pool')
+
+
+class AccountPool:
+    def __init__(self, collection):
+        self.collection = collection
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def seed_from_settings(self):
+        """Make sure the account from settings.ini is part of the pool."""
+        if 'Clubhouse' in SETTINGS.config and not self.collection.find_one({'_id': SETTINGS['Clubhouse']['user_id']}):
+            add_account(self.collection,
+                        SETTINGS['Clubhouse']['user_id'],
+                        SETTINGS['Clubhouse']['user_token'],
+                        SETTINGS['Clubhouse']['user_device'])
+
+    def healthy(self):
+        """Accounts that are healthy enough, plus those on probation after a quarantine, healthiest first."""
+        now = datetime.now(timezone.utc)
+        min_health = SETTINGS.getfloat('Accounts', 'min_health', fallback=0.2)
+        return list(self.collection.find({'$or': [{'quarantined_until': None, 'health': {'$gte': min_health}},
+                                                  {'quarantined_until': {'$lt': now}}]}).sort('health', DESCENDING))
+
+    def client(self, account) -> ClubhouseClient:
+        key = (account['_id'], account['user_token'], account['user_device'])
+        with self._lock:
+            client = self._clients.get(account['_id'])
+            if client is None or client.key != key:
+                client = ClubhouseClient(*key,
+                                         rate=account.get('rate', SETTINGS.getfloat('Clubhouse', 'api_rate', fallback=0.2)),
+                                         api_url=SETTINGS.get('Clubhouse', 'api_url', fallback=Clubhouse.API_URL))
+                self._clients[account['_id']] = client
+            return client
+
+    def get_event(self, event_hashid):
+        """get_event as the healthiest account, which is reported like any other call."""
+        accounts = self.healthy()
+        if not accounts:
+            logger.critical(f'No healthy account to get event {event_hashid}')
+            return {'detail': 'No healthy accounts'}
+        account = accounts[0]
+        data = self.client(account).get_event(event_hashid)
+        self.report(account, data)
+        return data
+
+    def report(self, account, data):
+        """Update the account's health from an API answer.
+
+        `account` may be stale, concurrent reports for the same account only meet in atomic updates.
+        """
+        if 'detail' in data:
+            account = self.collection.find_one_and_update({'_id': account['_id']},
+                                                          {'$inc': {'strikes': 1}, '$mul': {'health': 0.5}},
+                                                          return_document=ReturnDocument.AFTER)
+            quarantine = SETTINGS.getint('Accounts', 'quarantine', fallback=3600) * 2 ** (account['strikes'] - 1)
+            logger.critical(f'Account {account["_id"]} looks banned ({data["detail"]}), quarantined for {quarantine}s')
+            self.collection.update_one({'_id': account['_id']},
+                                       {'$max': {'quarantined_until': datetime.now(timezone.utc) + timedelta(seconds=quarantine)}})
+        elif data.get('success') and (account.get('health', 1.0) < 1.0 or account.get('strikes')
+                                      or account.get('quarantined_until')):
+            self.collection.update_one({'_id': account['_id']},
+                                       {'$inc': {'health': 0.1},
+                                        '$set': {'strikes': 0, 'quarantined_until': None}})
+            self.collection.update_one({'_id': account['_id'], 'health': {'$gt': 1.0}},
+                                       {'$set': {'health': 1.0}})
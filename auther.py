@@ -1,5 +1,8 @@
 from clubhouse import Clubhouse
 import configparser
+from pymongo import MongoClient
+
+from accounts import add_account
 
 input("[Step 1] Send a Clubhouse invite to a fake phone number. Press Enter when ready.")
 client = Clubhouse()
@@ -54,3 +57,5 @@ config['Telegram'] = {'token': tg_token,
 
 with open('settings.ini', 'w') as configfile:
     config.write(configfile)
+
+add_account(MongoClient(host='localhost:27017', tz_aware=True)['clubhouse']['accounts'], user_id, user_token, user_device)
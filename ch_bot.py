@@ -1,13 +1,23 @@
-from telegram import Update
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler, \
+    CallbackQueryHandler
 import urllib.parse
 import logging.config
 from clubhouse import Clubhouse
 from datetime import datetime, timezone
+from time import monotonic
 import pytz
 from pymongo import MongoClient
-import configparser
 import psutil
+from accounts import AccountPool, add_account
+from chatpool import ChatExecutor
+from eventcache import EventCache
+import metrics
+from notifier import bot_urls
+from schema import ensure_indexes, subscribe
+from settings import SETTINGS
+from transcoder import PROFILES, default_profile
 
 LOGGING = {
     'version': 1,
@@ -51,6 +61,13 @@ CLIENT = MongoClient(host='localhost:27017',
                      )
 TASKS = CLIENT['clubhouse']['tasks']
 QUEUE = CLIENT['clubhouse']['queue']
+ACCOUNTS = AccountPool(CLIENT['clubhouse']['accounts'])
+USERS = CLIENT['clubhouse']['users']
+STATUS_PAGE = 10
+STATUS_CACHE = {}
+
+HANDLERS = ChatExecutor(SETTINGS.getint('Telegram', 'workers', fallback=8))
+EVENTS = EventCache(CLIENT['clubhouse']['events'], ACCOUNTS.get_event)
 
 logger = logging.getLogger(__name__)
 
@@ -58,49 +75,91 @@ logger = logging.getLogger(__name__)
 def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
     logger.debug(f'START from {update.message.chat_id}')
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
-
-    WHITE_LIST = config['Telegram']['white_list'].split(',')
-    if str(update.message.chat_id) not in WHITE_LIST:
+    if not SETTINGS.is_allowed(update.message.chat_id):
         update.message.reply_html(
             f"We are under ban from Clubhouse. Check https://www.reddit.com/r/ClubhouseApp/comments/lqi79i/recording_clubhouse_crash_course/")
     else:
         update.message.reply_html('Just send me a link to a room or an event')
 
 
-def status(update: Update, context: CallbackContext) -> None:
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
+def status_snapshot(page):
+    """Counts, oldest recordings and next events in one aggregation, cached for a few seconds."""
+    cached = STATUS_CACHE.get(page)
+    if cached and monotonic() - cached[0] < SETTINGS.getfloat('Telegram', 'status_cache', fallback=5):
+        return cached[1]
+
+    skip = page * STATUS_PAGE
+    result = next(TASKS.aggregate([
+        {'$project': {'status': 1, 'topic': 1, 'dt': 1, 'pid': 1}},
+        {'$unionWith': {'coll': QUEUE.name,
+                        'pipeline': [{'$project': {'status': {'$literal': 'QUEUED'}, 'time_start': 1}}]}},
+        {'$facet': {
+            'counts': [{'$group': {'_id': '$status', 'n': {'$sum': 1}}}],
+            'recording': [{'$match': {'status': 'DOWNLOADING'}},
+                          {'$sort': {'dt': 1}},
+                          {'$skip': skip},
+                          {'$limit': STATUS_PAGE}],
+            'upcoming': [{'$match': {'status': 'QUEUED'}},
+                         {'$sort': {'time_start': 1}},
+                         {'$skip': skip},
+                         {'$limit': STATUS_PAGE}],
+        }},
+    ]))
+    counts = {c['_id']: c['n'] for c in result['counts']}
+    act_rec = counts.get('DOWNLOADING', 0)
+    in_queue = counts.get('QUEUED', 0)
+
+    now = datetime.now(timezone.utc)
+    act_tasks = '\n'.join(
+        ['{}: {} /kill_{}'.format(task.get('topic'), now - task['dt'], task.get('pid')) for task in result['recording']])
+    future_tasks = '\n'.join([str(task['time_start'] - now) for task in result['upcoming']])
+
+    text = (f'<b>Recording:</b> {act_rec}\n'
+            f'{act_tasks}\n'
+            f'<b>Waiting for a recorder:</b> {counts.get("GOT_TOKEN", 0)}\n'
+            f'<b>Waiting in queue:</b> {in_queue}\n'
+            f'{future_tasks}')
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton('<', callback_data=f'status:{page - 1}'))
+    if skip + STATUS_PAGE < max(act_rec, in_queue):
+        buttons.append(InlineKeyboardButton('>', callback_data=f'status:{page + 1}'))
+    markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+    STATUS_CACHE[page] = (monotonic(), (text, markup))
+    return text, markup
+
 
-    WHITE_LIST = config['Telegram']['white_list'].split(',')
-    if str(update.message.chat_id) not in WHITE_LIST:
+def status(update: Update, context: CallbackContext) -> None:
+    if not SETTINGS.is_allowed(update.message.chat_id):
         logger.warning(f'Unknown user {update.message.chat_id}')
         update.message.reply_html(
             f"We are under ban from Clubhouse. Check https://www.reddit.com/r/ClubhouseApp/comments/lqi79i/recording_clubhouse_crash_course/")
         return
     logger.debug(f'STATUS from {update.message.chat_id}')
-    act_rec = TASKS.count_documents({'status': 'DOWNLOADING'})
-    in_queue = QUEUE.count_documents({})
+    text, markup = status_snapshot(0)
+    update.message.reply_html(text, reply_markup=markup)
 
-    act_tasks = '\n'.join(
-        ['{}: {} /kill_{}'.format(task['topic'], datetime.now(timezone.utc) - task['dt'], task['pid']) for task in
-         TASKS.find({'status': 'DOWNLOADING'})])
-    future_tasks = '\n'.join([str(task['time_start'] - datetime.now(timezone.utc)) for task in QUEUE.find()])
 
-    update.message.reply_html(f'<b>Recording:</b> {act_rec}\n'
-                              f'{act_tasks}\n'
-                              f'<b>Waiting in queue:</b> {in_queue}\n'
-                              f'{future_tasks}'
-                              )
+def status_page(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    if not SETTINGS.is_allowed(update.effective_chat.id):
+        query.answer()
+        return
+    page = int(query.data.split(':')[1])
+    logger.debug(f'STATUS page {page} from {update.effective_chat.id}')
+    text, markup = status_snapshot(page)
+    query.answer()
+    try:
+        query.edit_message_text(text, parse_mode='HTML', reply_markup=markup)
+    except BadRequest as e:
+        # Message is not modified
+        logger.debug(e)
 
 
 def auth(update: Update, context: CallbackContext) -> int:
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
-
-    WHITE_LIST = config['Telegram']['white_list'].split(',')
-    if str(update.message.chat_id) not in WHITE_LIST:
+    if not SETTINGS.is_allowed(update.message.chat_id):
         update.message.reply_html(
             f"We are under ban from Clubhouse. Check https://www.reddit.com/r/ClubhouseApp/comments/lqi79i/recording_clubhouse_crash_course/")
     else:
@@ -159,15 +218,13 @@ def final(update: Update, context: CallbackContext) -> int:
     Clubhouse(user_id=context.user_data['user_id'],
               user_token=context.user_data['user_token'],
               user_device=context.user_data['user_device']).update_username(update.message.text)
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
-
-    config['Clubhouse'] = {'user_device': context.user_data['user_device'],
-                           'user_id': context.user_data['user_id'],
-                           'user_token': context.user_data['user_token']}
-
-    with open('settings.ini', 'w') as configfile:
-        config.write(configfile)
+    SETTINGS.update('Clubhouse', {'user_device': context.user_data['user_device'],
+                                  'user_id': context.user_data['user_id'],
+                                  'user_token': context.user_data['user_token']})
+    add_account(ACCOUNTS.collection,
+                context.user_data['user_id'],
+                context.user_data['user_token'],
+                context.user_data['user_device'])
 
     update.message.reply_html('All done.')
     return ConversationHandler.END
@@ -184,11 +241,7 @@ def cancel(update: Update, context: CallbackContext) -> int:
 
 
 def room_msg(update: Update, context: CallbackContext) -> None:
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
-
-    WHITE_LIST = config['Telegram']['white_list'].split(',')
-    if str(update.message.chat_id) not in WHITE_LIST:
+    if not SETTINGS.is_allowed(update.message.chat_id):
         logger.warning(f'Unknown user {update.message.chat_id}')
         update.message.reply_html(
             f"We are under ban from Clubhouse. Check https://www.reddit.com/r/ClubhouseApp/comments/lqi79i/recording_clubhouse_crash_course/")
@@ -201,46 +254,42 @@ def room_msg(update: Update, context: CallbackContext) -> None:
 
     if cur_task:
         logger.debug('We already know about that room')
-        TASKS.update_one({
-            '_id': room_id
-        }, {
-            '$addToSet': {'users': update.message.chat_id}
-        })
+        subscribe(TASKS, room_id, [update.message.chat_id])
         logger.info(f'Added {update.message.chat_id} to ROOM {room_id}')
-        update.message.reply_html(f"Recording {cur_task['topic']}. We'll notify you as soon as it's over.")
+        if cur_task.get('position'):
+            update.message.reply_html(f"All recorders are busy, {cur_task['topic']} is #{cur_task['position']} in line. "
+                                      f"We'll notify you as soon as it's over.")
+        else:
+            update.message.reply_html(f"Recording {cur_task.get('topic', room_id)}. We'll notify you as soon as it's over.")
     else:
         logger.info(f'{room_id}: New room ')
 
         active_downloads = TASKS.count_documents({'status': 'DOWNLOADING',
-                                                  'users': [update.message.chat_id],
+                                                  'users': update.message.chat_id,
                                                   })
 
-        all_downloads = TASKS.count_documents({'status': 'DOWNLOADING',
-                                               })
+        queued = TASKS.count_documents({'status': 'GOT_TOKEN'})
 
         if active_downloads > 10:
             logger.warning(f'Greedy user {update.message.chat_id}: {active_downloads}')
             update.message.reply_html(f"You are too greedy! You have standalone {active_downloads} active downloads.")
-        elif all_downloads > 80:
-            logger.error(f'Out of quota')
+        elif queued > SETTINGS.getint('Recorder', 'max_queue', fallback=200):
+            logger.error(f'Out of quota: {queued} rooms waiting for a recorder')
             update.message.reply_html(f"Out of quota. Please try again later")
         else:
             logger.error(f'{room_id}: New')
             TASKS.insert_one({'_id': room_id,
                               'status': 'WAITING_FOR_TOKEN',
                               'dt': datetime.utcnow(),
-                              'users': [update.message.chat_id]
+                              'users': [update.message.chat_id],
+                              'priority': 1
                               })
             update.message.reply_html(
                 f"Preparing to record that room. Because of some new limits from Clubhouse that can take some time.")
 
 
 def event_msg(update: Update, context: CallbackContext) -> None:
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
-
-    WHITE_LIST = config['Telegram']['white_list'].split(',')
-    if str(update.message.chat_id) not in WHITE_LIST:
+    if not SETTINGS.is_allowed(update.message.chat_id):
         logger.warning(f'Unknown user {update.message.chat_id}')
         update.message.reply_html(
             f"We are under ban from Clubhouse. Check https://www.reddit.com/r/ClubhouseApp/comments/lqi79i/recording_clubhouse_crash_course/")
@@ -249,12 +298,7 @@ def event_msg(update: Update, context: CallbackContext) -> None:
     event_id = urllib.parse.urlparse(update.message.text).path.split('/')[-1]
     logger.info(f'EVENT from {update.message.chat_id}: {event_id}')
 
-    client = Clubhouse(
-        user_id=config['Clubhouse']['user_id'],
-        user_token=config['Clubhouse']['user_token'],
-        user_device=config['Clubhouse']['user_device']
-    )
-    data = client.get_event(event_hashid=event_id)
+    data = EVENTS.get(event_id)
 
     if data.get('success', False):
         logger.debug('Found an event.')
@@ -274,11 +318,7 @@ def event_msg(update: Update, context: CallbackContext) -> None:
 
             if cur_task:
                 logger.debug('We already know about that room')
-                TASKS.update_one({
-                    '_id': room_id
-                }, {
-                    '$addToSet': {'users': update.message.chat_id}
-                })
+                subscribe(TASKS, room_id, [update.message.chat_id])
                 logger.info(f'Added {update.message.chat_id} to ROOM {room_id}')
                 update.message.reply_html(f"Recording <b>{topic}</b>. We'll notify you as soon as it's over.")
             else:
@@ -286,7 +326,8 @@ def event_msg(update: Update, context: CallbackContext) -> None:
                 TASKS.insert_one({'_id': room_id,
                                   'status': 'WAITING_FOR_TOKEN',
                                   'dt': datetime.utcnow(),
-                                  'users': [update.message.chat_id]
+                                  'users': [update.message.chat_id],
+                                  'priority': 1
                                   })
                 update.message.reply_html(
                     f"Preparing to record that room. Because of some new limits from Clubhouse that can take some time.")
@@ -309,11 +350,7 @@ def event_msg(update: Update, context: CallbackContext) -> None:
 
 
 def kill(update: Update, context: CallbackContext) -> None:
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
-
-    WHITE_LIST = config['Telegram']['white_list'].split(',')
-    if str(update.message.chat_id) not in WHITE_LIST:
+    if not SETTINGS.is_allowed(update.message.chat_id):
         logger.warning(f'Unknown user {update.message.chat_id}')
         update.message.reply_html(
             f"We are under ban from Clubhouse. Check https://www.reddit.com/r/ClubhouseApp/comments/lqi79i/recording_clubhouse_crash_course/")
@@ -328,6 +365,37 @@ def kill(update: Update, context: CallbackContext) -> None:
     update.message.reply_html(f"Killed")
 
 
+def profile(update: Update, context: CallbackContext) -> None:
+    """/profile shows the encoding profiles, /profile <name> picks one, /profile default goes back to the default."""
+    if not SETTINGS.is_allowed(update.message.chat_id):
+        logger.warning(f'Unknown user {update.message.chat_id}')
+        update.message.reply_html(
+            f"We are under ban from Clubhouse. Check https://www.reddit.com/r/ClubhouseApp/comments/lqi79i/recording_clubhouse_crash_course/")
+        return
+
+    chat_id = update.message.chat_id
+    if context.args:
+        name = context.args[0]
+        logger.info(f'PROFILE from {chat_id}: {name}')
+        if name == 'default':
+            USERS.update_one({'_id': chat_id}, {'$unset': {'profile': ''}})
+        elif name in PROFILES:
+            USERS.update_one({'_id': chat_id}, {'$set': {'profile': name}}, upsert=True)
+        else:
+            update.message.reply_html(f"Unknown profile <b>{name}</b>")
+            return
+
+    default = default_profile()
+    current = (USERS.find_one({'_id': chat_id}) or {}).get('profile', default)
+    lines = []
+    for name in PROFILES:
+        line = f'<b>{name}</b>' if name == current else name
+        lines.append(f'{line} (default)' if name == default else line)
+    names = '\n'.join(lines)
+    update.message.reply_html(f"Rooms will be sent to you as <b>{current}</b>.\n\n{names}\n\n"
+                              f"Use /profile &lt;name&gt; to change it.")
+
+
 def error(update: Update, context: CallbackContext):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
@@ -335,16 +403,18 @@ def error(update: Update, context: CallbackContext):
 
 def main():
     """Start the bot."""
+    ensure_indexes(CLIENT['clubhouse'])
+    ACCOUNTS.seed_from_settings()
+    metrics.start('ch_bot')
 
-    config = configparser.ConfigParser()
-    config.read('settings.ini')
-
-    updater = Updater(config['Telegram']['token'])
+    updater = Updater(SETTINGS['Telegram']['token'], **bot_urls())
 
     dispatcher = updater.dispatcher
 
     dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("status", status))
+    dispatcher.add_handler(CommandHandler("status", HANDLERS.wrap(status)))
+    dispatcher.add_handler(CallbackQueryHandler(HANDLERS.wrap(status_page), pattern='^status:'))
+    dispatcher.add_handler(CommandHandler("profile", HANDLERS.wrap(profile)))
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('auth', auth)],
         states={
@@ -358,18 +428,30 @@ def main():
 
     dispatcher.add_handler(conv_handler)
 
-    dispatcher.add_handler(MessageHandler(Filters.regex('^(\/kill_.+)$'), kill))
+    dispatcher.add_handler(MessageHandler(Filters.regex('^(\/kill_.+)$'), HANDLERS.wrap(kill)))
 
-    dispatcher.add_handler(MessageHandler(Filters.regex('joinclubhouse\.com\/room\/.*$') & ~Filters.command, room_msg))
+    dispatcher.add_handler(MessageHandler(Filters.regex('joinclubhouse\.com\/room\/.*$') & ~Filters.command, HANDLERS.wrap(room_msg)))
     dispatcher.add_handler(
-        MessageHandler(Filters.regex('joinclubhouse\.com\/event\/.*$') & ~Filters.command, event_msg))
+        MessageHandler(Filters.regex('joinclubhouse\.com\/event\/.*$') & ~Filters.command, HANDLERS.wrap(event_msg)))
 
     dispatcher.add_error_handler(error)
-    updater.start_polling()
+    webhook_url = SETTINGS.get('Telegram', 'webhook_url')
+    if webhook_url:
+        token = SETTINGS['Telegram']['token']
+        updater.start_webhook(listen=SETTINGS.get('Telegram', 'webhook_listen', fallback='0.0.0.0'),
+                              port=SETTINGS.getint('Telegram', 'webhook_port', fallback=8443),
+                              url_path=token,
+                              key=SETTINGS.get('Telegram', 'webhook_key'),
+                              cert=SETTINGS.get('Telegram', 'webhook_cert'),
+                              webhook_url=f"{webhook_url.rstrip('/')}/{token}")
+        logger.info(f'Listening for webhooks at {webhook_url}')
+    else:
+        updater.start_polling()
     updater.idle()
 
 
 if __name__ == '__main__':
     AUTH, SMS_CODE, FAKE_NAME, FAKE_LOGIN = range(4)
     empty_client = Clubhouse()
+    SETTINGS.install_sighup()
     main()
@@ -2,21 +2,33 @@
 
 import traceback
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime, timezone, timedelta
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from pathlib import Path
-from telegram.ext import Updater
-import telegram
 import os
-from time import sleep
+import queue
+from time import monotonic, sleep
 import shutil
-import configparser
-from clubhouse import Clubhouse
 import unicodedata
 import re
 
 import logging.config
 
+from accounts import AccountPool
+from dispatch import Stage, Watcher
+from eventcache import EventCache
+import metrics
+from metrics import observe_status, RECORDS_BYTES, ROOMS_DELIVERED, STATUS_SECONDS, TRIMMED_SECONDS, TRIMMED_BYTES
+from notifier import NOTIFIER, GONE, part_size, upload_limit
+from recordings import RecordingIndex
+from scheduler import EventScheduler
+from schema import ensure_indexes, subscribe
+from settings import SETTINGS
+from storage import scratch_dir, sweep
+from transcoder import transcode, default_profile, probe, silence_filter, LiveEncoder, PROFILES, TranscodeError
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -57,6 +69,26 @@ logging.config.dictConfig(LOGGING)
 CLIENT = MongoClient(host='localhost:27017', tz_aware=True)
 TASKS = CLIENT['clubhouse']['tasks']
 QUEUE = CLIENT['clubhouse']['queue']
+USERS = CLIENT['clubhouse']['users']
+
+TOKEN_STAGE = Stage('process_token', {'WAITING_FOR_TOKEN'}, poll_interval=5)
+QUEUE_STAGE = Stage('process_queue', poll_interval=30)
+
+# ffmpeg is CPU bound, uploads are not: finished rooms are handled concurrently
+# and every transcode job waits for one of cpu_count() ffmpeg slots
+TRANSCODER = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='ffmpeg')
+ROOMS = ThreadPoolExecutor(max_workers=SETTINGS.getint('Audio', 'rooms', fallback=8), thread_name_prefix='room')
+IN_FLIGHT = set()
+# Held while a room moves into IN_FLIGHT and while process_live starts an encoder for it
+LIVE_LOCK = threading.Lock()
+RECORDINGS = RecordingIndex('records')
+LIVE = {}
+
+SCHEDULER = EventScheduler()
+
+ACCOUNTS = AccountPool(CLIENT['clubhouse']['accounts'])
+TOKEN_IN_FLIGHT = set()
+EVENTS = EventCache(CLIENT['clubhouse']['events'], ACCOUNTS.get_event)
 
 logger = logging.getLogger(__name__)
 
@@ -68,341 +100,501 @@ def clean_filename(filename):
     return re.sub(r'[-\s]+', '-', value).strip('-_')[:250]
 
 
-def run_cmd(cmd):
-    os.system(cmd)
+def send_part(task, profile, users, path, counter, title):
+    file_id = task.get('file_ids', {}).get(profile, {}).get(str(counter))
+    if PROFILES[profile]['send'] == 'voice':
+        file_id, sent = NOTIFIER.send_voice(users, path, caption=title, file_id=file_id)
+    else:
+        file_id, sent = NOTIFIER.send_audio(users, path, title=title, file_id=file_id)
+    if file_id:
+        TASKS.update_one({'_id': task['_id']},
+                         {'$set': {f'file_ids.{profile}.{counter}': file_id}})
+    return sent
+
+
+def send_parts(task, profile, parts, recipients, first, numbered, gone):
+    """Send parts in order. task['cursor'] holds the last part each user got, so a restart resumes there.
+
+    Returns the users that got every part. Lost chats are added to `gone`; users that failed
+    for now are left out of the later parts and stay behind for the next attempt.
+    """
+    cursor = task.setdefault('cursor', {}).setdefault(profile, {})
+    for counter, ch in enumerate(parts, first):
+        part_title = f"{task['topic']}: part {counter}" if numbered else task['topic']
+        pending = [user for user in recipients if cursor.get(str(user), 0) < counter]
+        if not pending:
+            continue
+        logger.info(f'Sending {ch} to {len(pending)} users')
+        sent = send_part(task, profile, pending, ch, counter, part_title)
+        gone.update(user for user, message in sent.items() if message is GONE)
+        delivered = [user for user, message in sent.items() if message is not GONE]
+        if delivered:
+            cursor.update({str(user): counter for user in delivered})
+            TASKS.update_one({'_id': task['_id']},
+                             {'$set': {f'cursor.{profile}.{user}': counter for user in delivered}})
+        recipients = [user for user in recipients if user in delivered or user not in pending]
+    return recipients
+
+
+def valid_parts(parts):
+    """Paths of persisted parts, or None if any of the files is gone or has changed."""
+    for part in parts:
+        path = Path(part['path'])
+        if not path.is_file() or path.stat().st_size != part['size']:
+            return None
+    return [part['path'] for part in parts]
+
+
+def stored_parts(task, profile):
+    """Parts persisted by an earlier run, if every file is still there and complete."""
+    parts = task.get('parts', {}).get(profile)
+    return valid_parts(parts) if parts else None
+
+
+def save_parts(room_id, profile, parts):
+    TASKS.update_one({'_id': room_id},
+                     {'$set': {f'parts.{profile}': [{'path': str(p), 'size': Path(p).stat().st_size} for p in parts]}})
+
+
+def save_live(room_id, encoder):
+    TASKS.update_one({'_id': room_id}, {'$set': {f'live.{encoder.profile}': encoder.state()}})
+
+
+def resume_live(task, profile, filename, directory, target_size):
+    """A LiveEncoder that carries on from the state an earlier run stored, or None."""
+    state = task.get('live', {}).get(profile)
+    if not state or state['filename'] != str(filename) or valid_parts(state['parts']) is None:
+        return None
+    encoder = LiveEncoder(filename, directory, clean_filename(task['topic']), target_size, profile,
+                          silence_filter(profile))
+    encoder.resume(state)
+    logger.info(f'{task["_id"]}: resuming live encoding after {len(state["parts"])} parts')
+    return encoder
+
+
+def profile_groups(users):
+    """Group users by the encoding profile they picked with /profile."""
+    default = default_profile()
+    chosen = {doc['_id']: doc['profile']
+              for doc in USERS.find({'_id': {'$in': users}, 'profile': {'$in': list(PROFILES)}})}
+    groups = {}
+    for user in users:
+        groups.setdefault(chosen.get(user, default), []).append(user)
+    return groups
+
+
+def record_trim(room_id, profile, filename, parts):
+    """Log and count how much silence was cut: the recording's duration minus what ended up in the parts.
+
+    Called once the parts are sent, so a failing probe costs only the numbers.
+    """
+    try:
+        duration, _ = probe(filename)
+        kept = sum(probe(part)[0] for part in parts)
+    except Exception as e:
+        logger.warning(f'{room_id}: cannot measure trimmed {profile} silence: {e}')
+        return
+    seconds = max(0, duration - kept)
+    size = seconds * PROFILES[profile]['bitrate'] / 8
+    logger.info(f'{room_id}: trimmed {seconds:.0f}s of {profile} silence, about {size / 1000 / 1000:.1f} MB')
+    TRIMMED_SECONDS.labels(profile).inc(seconds)
+    TRIMMED_BYTES.labels(profile).inc(size)
+
+
+def deliver_profile(task, profile, users, filename, directory, encoder, target_size, limit, timeout, gone):
+    room_id = task['_id']
+    parts = stored_parts(task, profile)
+    live = encoder is not None and encoder.filename == str(filename) and encoder.profile == profile
+    if not parts and not live:
+        encoder = resume_live(task, profile, filename, directory, target_size)
+        live = encoder is not None
+    if not parts and not live and (task.get('cursor', {}).get(profile) or task.get('file_ids', {}).get(profile)):
+        # The parts are going to be cut again and may not line up with what was sent before
+        logger.warning(f'{room_id}: stored {profile} parts are gone, delivering from the start')
+        task.get('cursor', {}).pop(profile, None)
+        task.get('file_ids', {}).pop(profile, None)
+        TASKS.update_one({'_id': room_id}, {'$unset': {f'cursor.{profile}': '', f'file_ids.{profile}': ''}})
+    ready = encoder.ready() if live else []
+    if parts:
+        logger.info(f'{room_id}: resuming delivery of {len(parts)} {profile} parts')
+        return send_parts(task, profile, parts, users, 1, len(parts) > 1, gone)
+    if ready:
+        logger.info(f'{room_id}: {len(ready)} parts were encoded live, finishing the tail')
+        # A restart while these go out resumes from here instead of cutting the room again
+        save_live(room_id, encoder)
+        tail = TRANSCODER.submit(encoder.finish, limit, timeout, len(ready))
+        recipients = send_parts(task, profile, ready, users, 1, True, gone)
+        tail = tail.result()
+        save_parts(room_id, profile, ready + tail)
+        recipients = send_parts(task, profile, tail, recipients, len(ready) + 1, True, gone)
+        if encoder.silence:
+            record_trim(room_id, profile, filename, ready + tail)
+        return recipients
+    silence = silence_filter(profile)
+    parts = TRANSCODER.submit(transcode, filename, directory, clean_filename(task['topic']),
+                              target_size, limit, timeout, profile, silence).result()
+    save_parts(room_id, profile, parts)
+    recipients = send_parts(task, profile, parts, users, 1, len(parts) > 1, gone)
+    if silence:
+        record_trim(room_id, profile, filename, parts)
+    return recipients
+
+
+def deliver_room(task, directory):
+    if not task.get('attempts'):
+        observe_status(task)
+    started = monotonic()
+    room_id = task['_id']
+    users = task['users']
+    title = task['topic']
+    work = scratch_dir(room_id, directory)
+    file_list = list(Path(directory).glob('*_*.aac'))
+    if file_list:
+        filename = file_list[0]
+        logger.info(f'Audio ready!: {filename} {Path(filename).stat().st_size}')
+        timeout = SETTINGS.getint('Audio', 'transcode_timeout', fallback=3 * 3600)
+        target_size = part_size()
+        limit = upload_limit()
+        encoder = LIVE.pop(room_id, None)
+        recipients = []
+        gone = set()
+        try:
+            for profile, group in profile_groups(users).items():
+                recipients += deliver_profile(task, profile, group, filename, work, encoder,
+                                              target_size, limit, timeout, gone)
+        except TranscodeError as e:
+            logger.critical(f'{room_id}: {e}')
+            TASKS.update_one({'_id': room_id}, {'$set': {'status': 'FAILED', 'error': str(e)}})
+            NOTIFIER.notify(users, f"Room <b>{title}</b> was recorded, but we failed to convert it. Sorry :(")
+            return
+
+        logger.info(f'Sent files to users {recipients}')
+        failed = [user for user in users if user not in recipients and user not in gone]
+        attempts = task.get('attempts', 0) + 1
+        if failed and attempts < SETTINGS.getint('Telegram', 'delivery_attempts', fallback=5):
+            # Keep the task, the recording and the parts: the next sweep picks the room up again
+            logger.warning(f'{room_id}: delivery to {failed} failed, retrying later ({attempts})')
+            TASKS.update_one({'_id': room_id},
+                             {'$pullAll': {'users': [user for user in users if user not in failed]},
+                              '$set': {'attempts': attempts}})
+            return
+        if failed:
+            logger.error(f'{room_id}: giving up on {failed} after {attempts} attempts')
+        STATUS_SECONDS.labels('DELIVERING').observe(monotonic() - started)
+        ROOMS_DELIVERED.inc()
+        TASKS.update_one({'_id': room_id},
+                         {'$pullAll': {'users': users}})
+    else:
+        logger.warning('No recording!')
+
+        logger.info(f'Informing {users}')
+        NOTIFIER.notify(users, f"Room <b>{title}</b> was not recorded for some reason. Usually that means that there were no active speakers for several minutes.")
+
+    TASKS.delete_one({'_id': room_id})
+
+    logger.info(f'Removing dir {directory}')
+    shutil.rmtree(directory)
+    shutil.rmtree(work, ignore_errors=True)
+    RECORDINGS.forget(room_id)
+
+
+def finish_room(room_id, future):
+    IN_FLIGHT.discard(room_id)
+    if future.exception():
+        logger.critical(f'deliver_room {room_id} has broken', exc_info=future.exception())
 
 
 def process_audiofiles():
+    """Deliver rooms as soon as RECORDINGS sees their done marker.
+
+    Every sweep_interval seconds all finished recordings are retried, for rooms
+    that were finished before their task reached DOWNLOADING.
+    """
+    swept = monotonic()
     while True:
-        sleep(5)
+        interval = SETTINGS.getint('Audio', 'sweep_interval', fallback=60)
+        try:
+            room_ids = [RECORDINGS.ready.get(timeout=max(0, swept + interval - monotonic()))]
+        except queue.Empty:
+            room_ids = []
+        # Due even when the queue never goes quiet
+        if monotonic() - swept >= interval:
+            room_ids = RECORDINGS.finished()
+            swept = monotonic()
         try:
-            for task in TASKS.find({'status': 'DOWNLOADING'}):
+            for task in TASKS.find({'status': 'DOWNLOADING', '_id': {'$in': room_ids, '$nin': list(IN_FLIGHT)}}):
                 room_id = task['_id']
-
-                users = task['users']
-                title = task['topic']
-                for p in Path('records').glob(f'*/{room_id}_*/recording2-done.txt'):
-                    logger.info(f'{room_id} seems to be ready')
-                    directory = p.parent
-                    file_list = list(Path(directory).glob('*_*.aac'))
-                    if file_list:
-                        filename = list(Path(directory).glob('*_*.aac'))[0]
-                        filesize = Path(filename).stat().st_size
-                        logger.info(f'Audio ready!: {filename} {filesize}')
-                        safe_filename = clean_filename(title)
-
-                        if filesize > 30 * 1024 * 1024:
-                            logger.info('Large file, chopping...')
-                            cmd = f'ffmpeg -i {filename} -y -f segment -segment_time 3600 -c copy {directory}/out%03d.aac'
-                            logger.info(cmd)
-                            os.system(cmd)
-
-                            c = 0
-                            for ch in sorted([str(k) for k in Path(directory).glob('out*.aac')]):
-                                cmd = f'ffmpeg -i {ch} -y -acodec libmp3lame {directory}/{safe_filename}_part_{c}.mp3'
-                                logger.info(cmd)
-                                os.system(cmd)
-                                c += 1
-
-                            for user in users:
-                                logger.info(f'Sending {room_id} files to user {user} {len(users)}')
-                                counter = 1
-                                for ch in sorted([str(k) for k in Path(directory).glob('*.mp3')]):
-                                    try:
-                                        logger.info(f'Sent {ch}')
-                                        sleep(5)
-                                        config = configparser.ConfigParser()
-                                        config.read('settings.ini')
-
-                                        Updater(config['Telegram']['token']).bot.send_audio(
-                                            chat_id=user,
-                                            audio=open(ch, 'rb'),
-                                            title=f'{title}: part {counter}')
-                                    except telegram.error.Unauthorized:
-                                        logger.warning(f'{user} banned the bot!')
-                                        break
-
-                                    counter += 1
-                                logger.info(f'Sent files to user {user}')
-                                TASKS.update_one({'_id': room_id},
-                                                 {'$pull': {'users': user}})
-                        else:
-                            logger.info(f'Single file')
-                            cmd = f'ffmpeg -i {filename} -y -acodec libmp3lame {directory}/{safe_filename}.mp3'
-                            logger.info(cmd)
-                            os.system(cmd)
-
-                            for user in users:
-                                logger.info(f'Sending {room_id} file to user {user} {len(users)}')
-                                try:
-                                    sleep(5)
-                                    config = configparser.ConfigParser()
-                                    config.read('settings.ini')
-
-                                    Updater(config['Telegram']['token']).bot.send_audio(
-                                        chat_id=user,
-                                        audio=open(f'{directory}/{safe_filename}.mp3', 'rb'),
-                                        title=title)
-                                except telegram.error.Unauthorized:
-                                    logger.warning(f'{user} banned the bot!')
-                                logger.info(f'Sent files to user {user}')
-                                TASKS.update_one({'_id': room_id},
-                                                 {'$pull': {'users': user}})
-
-                        TASKS.delete_one({'_id': room_id})
-
-                        logger.info(f'Removing dir {directory}')
-                        shutil.rmtree(directory)
-                        break
-
-                    else:
-                        logger.warning('No recording!')
-
-                        for user in users:
-                            logger.info(f'Informing {user}')
-                            try:
-                                config = configparser.ConfigParser()
-                                config.read('settings.ini')
-
-                                Updater(config['Telegram']['token']).bot.send_message(
-                                    chat_id=user,
-                                    text=f"Room <b>{title}</b> was not recorded for some reason. Usually that means that there were no active speakers for several minutes.",
-                                    parse_mode='html')
-                            except telegram.error.Unauthorized:
-                                logger.warning(f'{user} banned the bot!')
-
-                        TASKS.delete_one({'_id': room_id})
-
-                        logger.info(f'Removing dir {directory}')
-                        shutil.rmtree(directory)
-                        break
+                directory = RECORDINGS.directory(room_id)
+                if directory is None:
+                    continue
+                with LIVE_LOCK:
+                    IN_FLIGHT.add(room_id)
+                ROOMS.submit(deliver_room, task, directory).add_done_callback(partial(finish_room, room_id))
 
         except:
             logger.critical(f'process_audiofiles has broken')
             print(traceback.format_exc())
 
 
-def process_token():
+def process_live():
+    """Encode closed segments of rooms that are still being recorded."""
     while True:
-        sleep(5)
+        sleep(SETTINGS.getint('Audio', 'live_interval', fallback=60))
+        # Only the default profile is encoded live; remuxing the whole room at the end is cheap anyway
+        profile = default_profile()
+        if not SETTINGS.getboolean('Audio', 'live', fallback=True) or PROFILES[profile].get('copy'):
+            continue
+        target_size = part_size()
+        limit = upload_limit()
+        timeout = SETTINGS.getint('Audio', 'transcode_timeout', fallback=3 * 3600)
         try:
-            for task in TASKS.find({'status': 'WAITING_FOR_TOKEN'}):
+            jobs = {}
+            finished = set(RECORDINGS.finished())
+            for task in TASKS.find({'status': 'DOWNLOADING', '_id': {'$nin': list(IN_FLIGHT)}}):
                 room_id = task['_id']
-                logger.info(f'Need token for {room_id}')
-                config = configparser.ConfigParser()
-                config.read('settings.ini')
-
-                data = Clubhouse(
-                    user_id=config['Clubhouse']['user_id'],
-                    user_token=config['Clubhouse']['user_token'],
-                    user_device=config['Clubhouse']['user_device']
-                ).join_channel(room_id)
-
-                users = task['users']
-                if data.get('success'):
-                    token = data['token']
-                    topic = data['topic']
-
-                    logger.debug(f'Got token for {room_id}: {token}')
-
-                    TASKS.update_one({'_id': room_id},
-                                     {'$set': {
-                                         'token': token,
-                                         'topic': topic,
-                                         'status': 'GOT_TOKEN'
-                                     }})
-                    for user in users:
-                        logger.info(f'Informing {user} about token')
-                        try:
-                            config = configparser.ConfigParser()
-                            config.read('settings.ini')
-
-                            Updater(config['Telegram']['token']).bot.send_message(
-                                chat_id=user,
-                                text=f"Recording <b>{topic}</b>. We'll notify you as soon as it's over.",
-                                parse_mode='html')
-                        except telegram.error.Unauthorized:
-                            logger.warning(f'{user} banned the bot!')
-                    sleep(5)
-                    config = configparser.ConfigParser()
-                    config.read('settings.ini')
-
-                    Clubhouse(
-                        user_id=config['Clubhouse']['user_id'],
-                        user_token=config['Clubhouse']['user_token'],
-                        user_device=config['Clubhouse']['user_device']
-                    ).leave_channel(room_id)
-                elif 'This room is no longer available' in data.get('error_message', ''):
-                    for user in users:
-                        logger.info(f'Informing {user}')
-                        try:
-                            config = configparser.ConfigParser()
-                            config.read('settings.ini')
-
-                            Updater(config['Telegram']['token']).bot.send_message(
-                                chat_id=user,
-                                text=f'Planned event has either expired or we were banned by clubhouse. Sorry :(',
-                                parse_mode='html')
-                        except telegram.error.Unauthorized:
-                            logger.warning(f'{user} banned the bot!')
-
-                    TASKS.delete_one({'_id': room_id})
-                else:
-                    TASKS.delete_one({'_id': room_id})
-                    logger.critical('NO TOKEN! BAN???')
-
-                    for user in users:
-                        logger.info(f'Informing {user}')
-                        try:
-                            config = configparser.ConfigParser()
-                            config.read('settings.ini')
-
-                            Updater(config['Telegram']['token']).bot.send_message(
-                                chat_id=user,
-                                text=f'This is probably ban',
-                                parse_mode='html')
-                        except telegram.error.Unauthorized:
-                            logger.warning(f'{user} banned the bot!')
-                sleep(25)
+                if room_id in finished:
+                    continue
+                with LIVE_LOCK:
+                    # deliver_room may have taken the room since the query ran
+                    if room_id in IN_FLIGHT:
+                        continue
+                    encoder = LIVE.get(room_id)
+                    if encoder is None:
+                        directory = RECORDINGS.directory(room_id)
+                        filename = next(directory.glob('*_*.aac'), None) if directory else None
+                        if filename is None:
+                            continue
+                        logger.info(f'{room_id}: live encoding {filename}')
+                        work = scratch_dir(room_id, directory)
+                        encoder = resume_live(task, profile, filename, work, target_size) or \
+                            LiveEncoder(filename, work, clean_filename(task['topic']), target_size, profile,
+                                        silence_filter(profile))
+                        LIVE[room_id] = encoder
+                jobs[room_id] = encoder, TRANSCODER.submit(encoder.poll, limit, timeout)
+            for room_id, (encoder, job) in jobs.items():
+                try:
+                    job.result()
+                    save_live(room_id, encoder)
+                except Exception:
+                    logger.exception(f'{room_id}: live encoding has broken')
+                    LIVE.pop(room_id, None)
         except:
-            logger.critical('process_token has broken')
+            logger.critical('process_live has broken')
             print(traceback.format_exc())
 
 
-def process_queue():
+def process_storage():
+    """Sweep orphaned recordings and keep disk_bytes current on every task."""
+    while True:
+        try:
+            rooms = sweep(TASKS)
+            RECORDS_BYTES.set(sum(rooms.values()))
+            updates = [UpdateOne({'_id': room_id}, {'$set': {'disk_bytes': size}}) for room_id, size in rooms.items()]
+            if updates:
+                TASKS.bulk_write(updates, ordered=False)
+        except:
+            logger.critical('process_storage has broken')
+            print(traceback.format_exc())
+        sleep(SETTINGS.getint('Storage', 'sweep_interval', fallback=600))
+
+
+def get_token(task, account):
+    room_id = task['_id']
+    client = ACCOUNTS.client(account)
+    logger.info(f'Need token for {room_id}, asking as {client.user_id}')
+    data = client.join_channel(room_id)
+    ACCOUNTS.report(account, data)
+
+    users = task['users']
+    if data.get('success'):
+        token = data['token']
+        topic = data['topic']
+
+        logger.debug(f'Got token for {room_id}: {token}')
+
+        observe_status(task)
+        TASKS.update_one({'_id': room_id},
+                         {'$set': {
+                             'token': token,
+                             'uid': client.user_id,
+                             'topic': topic,
+                             'status': 'GOT_TOKEN',
+                             'status_dt': datetime.now(timezone.utc)
+                         }})
+        logger.info(f'Informing {users} about token')
+        NOTIFIER.notify(users, f"Recording <b>{topic}</b>. We'll notify you as soon as it's over.")
+        client.leave_channel(room_id)
+    elif 'detail' in data:
+        logger.warning(f'{room_id}: account {client.user_id} is banned, leaving the room for another account')
+        TOKEN_STAGE.wake()
+    elif 'This room is no longer available' in data.get('error_message', ''):
+        logger.info(f'Informing {users}')
+        NOTIFIER.notify(users, f'Planned event has either expired or we were banned by clubhouse. Sorry :(')
+
+        TASKS.delete_one({'_id': room_id})
+    else:
+        TASKS.delete_one({'_id': room_id})
+        logger.critical('NO TOKEN! BAN???')
+
+        logger.info(f'Informing {users}')
+        NOTIFIER.notify(users, f'This is probably ban')
+
+
+def run_get_token(task, account):
+    try:
+        get_token(task, account)
+    except:
+        logger.critical(f'get_token {task["_id"]} has broken')
+        print(traceback.format_exc())
+    finally:
+        TOKEN_IN_FLIGHT.discard(task['_id'])
+
+
+def process_token():
+    """Spread rooms waiting for a token across every healthy account in the pool."""
+    with ThreadPoolExecutor(max_workers=SETTINGS.getint('Accounts', 'workers', fallback=8),
+                            thread_name_prefix='token') as pool:
+        while True:
+            TOKEN_STAGE.wait()
+            try:
+                accounts = ACCOUNTS.healthy()
+                if not accounts:
+                    logger.critical('Every Clubhouse account is quarantined')
+                    for task in TASKS.find({'status': 'WAITING_FOR_TOKEN', 'ban_notified': {'$ne': True}}):
+                        logger.info(f'Informing {task["users"]}')
+                        NOTIFIER.notify(task['users'], f'This is probably ban. We will keep trying while the room is live.')
+                        TASKS.update_one({'_id': task['_id']}, {'$set': {'ban_notified': True}})
+                    continue
+                tasks = TASKS.find({'status': 'WAITING_FOR_TOKEN', '_id': {'$nin': list(TOKEN_IN_FLIGHT)}}).sort('dt')
+                for i, task in enumerate(tasks):
+                    TOKEN_IN_FLIGHT.add(task['_id'])
+                    pool.submit(run_get_token, task, accounts[i % len(accounts)])
+            except:
+                logger.critical('process_token has broken')
+                print(traceback.format_exc())
+
+
+def check_event(event_id):
+    task = QUEUE.find_one({'_id': event_id})
+    if task is None:
+        return
+    users = task['users']
+    logger.debug(f'Tick-tock for {event_id}')
+
+    data = EVENTS.get(event_id)
+
+    if data.get('success'):
+        ev = data['event']
+        room_id = ev['channel']
+        topic = ev['name']
+
+        if ev['is_expired']:
+            logger.warning('Event expired!')
+            QUEUE.delete_one({'_id': event_id})
+            logger.info(f'Informing {users}')
+            NOTIFIER.notify(users, f'Event <b>{topic}</b> has either expired or we were banned by clubhouse')
+
+        elif ev['is_member_only']:
+            logger.warning('Private!')
+            QUEUE.delete_one({'_id': event_id})
+            logger.info(f'Informing {users}')
+            NOTIFIER.notify(users, f'Event <b>{topic}</b> is private, we cannot record it.')
+
+        elif room_id:
+            logger.info(f'Got room_id {room_id}')
+            cur_task = TASKS.find_one({'_id': room_id})
+
+            if cur_task:
+                logger.info('We already know about that room')
+                subscribe(TASKS, room_id, users)
+                QUEUE.delete_one({'_id': event_id})
+                logger.info(f'Informing {users}')
+                NOTIFIER.notify(users, f'Event <b>{topic}</b> has started. Preparing to record that room. Because of some new limits from Clubhouse that can take some time.')
+            else:
+                logger.error(f'{room_id}: New')
+                TASKS.insert_one({'_id': room_id,
+                                  'status': 'WAITING_FOR_TOKEN',
+                                  'topic': topic,
+                                  'users': users,
+                                  'priority': len(users),
+                                  'dt': datetime.utcnow()
+                                  })
+                QUEUE.delete_one({'_id': event_id})
+                logger.info(f'Informing {users}')
+                NOTIFIER.notify(users, f'Event <b>{topic}</b> has started. Preparing to record that room. Because of some new limits from Clubhouse that can take some time.')
+
+        elif datetime.now(timezone.utc) - task['time_start'] > timedelta(minutes=20):
+            logger.warning('Event expired by timeout!')
+            QUEUE.delete_one({'_id': event_id})
+
+        else:
+            recheck = SETTINGS.getint('Clubhouse', 'event_recheck', fallback=60)
+            SCHEDULER.add(event_id, check_at=datetime.now(timezone.utc) + timedelta(seconds=recheck))
+
+    else:
+        QUEUE.delete_one({'_id': event_id})
+        logger.critical('NO TOKEN! BAN???')
+
+        logger.info(f'Informing {users}')
+        NOTIFIER.notify(users, f'Failed to get event {event_id}')
+
+
+def run_check(event_id):
+    try:
+        check_event(event_id)
+    except:
+        logger.critical(f'check_event {event_id} has broken')
+        print(traceback.format_exc())
+    finally:
+        SCHEDULER.done(event_id)
+
+
+def sync_queue():
+    """Reload the schedule whenever the queue collection changes."""
     while True:
         try:
-            for task in QUEUE.find().batch_size(5):
-                event_id = task['_id']
-                users = task['users']
-                if task['time_start'] - datetime.now(timezone.utc) < timedelta(minutes=20):
-                    logger.debug(f'Tick-tock for {event_id}')
-
-                    config = configparser.ConfigParser()
-                    config.read('settings.ini')
-
-                    data = Clubhouse(
-                        user_id=config['Clubhouse']['user_id'],
-                        user_token=config['Clubhouse']['user_token'],
-                        user_device=config['Clubhouse']['user_device']
-                    ).get_event(event_hashid=event_id)
-
-                    if data.get('success'):
-                        ev = data['event']
-                        room_id = ev['channel']
-                        topic = ev['name']
-
-                        if ev['is_expired']:
-                            logger.warning('Event expired!')
-                            QUEUE.delete_one({'_id': event_id})
-                            for user in users:
-                                logger.info(f'Informing {user}')
-                                try:
-                                    config = configparser.ConfigParser()
-                                    config.read('settings.ini')
-
-                                    Updater(config['Telegram']['token']).bot.send_message(
-                                        chat_id=user,
-                                        text=f'Event <b>{topic}</b> has either expired or we were banned by clubhouse',
-                                        parse_mode='html')
-                                except telegram.error.Unauthorized:
-                                    logger.warning(f'{user} banned the bot!')
-
-                        elif ev['is_member_only']:
-                            logger.warning('Private!')
-                            QUEUE.delete_one({'_id': event_id})
-                            for user in users:
-                                logger.info(f'Informing {user}')
-                                try:
-                                    config = configparser.ConfigParser()
-                                    config.read('settings.ini')
-
-                                    Updater(config['Telegram']['token']).bot.send_message(
-                                        chat_id=user,
-                                        text=f'Event <b>{topic}</b> is private, we cannot record it.',
-                                        parse_mode='html')
-                                except telegram.error.Unauthorized:
-                                    logger.warning(f'{user} banned the bot!')
-
-                        elif room_id:
-                            logger.info(f'Got room_id {room_id}')
-                            cur_task = TASKS.find_one({'_id': room_id})
-
-                            if cur_task:
-                                logger.info('We already know about that room')
-                                TASKS.update_one({
-                                    '_id': room_id
-                                }, {
-                                    '$addToSet': {'users': users}
-                                })
-                                QUEUE.delete_one({'_id': event_id})
-                                for user in users:
-                                    logger.info(f'Informing {user}')
-                                    try:
-                                        config = configparser.ConfigParser()
-                                        config.read('settings.ini')
-
-                                        Updater(config['Telegram']['token']).bot.send_message(
-                                            chat_id=user,
-                                            text=f'Event <b>{topic}</b> has started. Preparing to record that room. Because of some new limits from Clubhouse that can take some time.',
-                                            parse_mode='html')
-                                    except telegram.error.Unauthorized:
-                                        logger.warning(f'{user} banned the bot!')
-                            else:
-                                logger.error(f'{room_id}: New')
-                                TASKS.insert_one({'_id': room_id,
-                                                  'status': 'WAITING_FOR_TOKEN',
-                                                  'topic': topic,
-                                                  'users': users,
-                                                  'dt': datetime.utcnow()
-                                                  })
-                                QUEUE.delete_one({'_id': event_id})
-                                for user in users:
-                                    logger.info(f'Informing {user}')
-                                    try:
-                                        config = configparser.ConfigParser()
-                                        config.read('settings.ini')
-
-                                        Updater(config['Telegram']['token']).bot.send_message(
-                                            chat_id=user,
-                                            text=f'Event <b>{topic}</b> has started. Preparing to record that room. Because of some new limits from Clubhouse that can take some time.',
-                                            parse_mode='html')
-                                    except telegram.error.Unauthorized:
-                                        logger.warning(f'{user} banned the bot!')
-
-                    else:
-                        QUEUE.delete_one({'_id': event_id})
-                        logger.critical('NO TOKEN! BAN???')
-
-                        for user in users:
-                            logger.info(f'Informing {user}')
-                            try:
-                                config = configparser.ConfigParser()
-                                config.read('settings.ini')
-
-                                Updater(config['Telegram']['token']).bot.send_message(
-                                    chat_id=user,
-                                    text=f'Failed to get event {event_id}',
-                                    parse_mode='html')
-                            except telegram.error.Unauthorized:
-                                logger.warning(f'{user} banned the bot!')
-                    sleep(15)
-                elif datetime.now(timezone.utc) - task['time_start'] > timedelta(minutes=20):
-                    logger.warning('Event expired by timeout!')
-                    QUEUE.delete_one({'_id': event_id})
+            SCHEDULER.load(QUEUE)
         except:
-            logger.critical('process_queue has broken')
+            logger.critical('sync_queue has broken')
             print(traceback.format_exc())
 
-        sleep(30)
+        QUEUE_STAGE.wait()
+
+
+def process_queue():
+    with ThreadPoolExecutor(max_workers=SETTINGS.getint('Clubhouse', 'event_workers', fallback=4),
+                            thread_name_prefix='event') as pool:
+        while True:
+            try:
+                for event_id in SCHEDULER.due():
+                    pool.submit(run_check, event_id)
+            except:
+                logger.critical('process_queue has broken')
+                print(traceback.format_exc())
+                sleep(30)
 
 
 if __name__ == "__main__":
     logger.info('Started cron!')
+    SETTINGS.install_sighup()
+    ensure_indexes(CLIENT['clubhouse'])
+    metrics.start('ch_cron')
+    ACCOUNTS.seed_from_settings()
+
+    RECORDINGS.start()
+    Watcher(TASKS, [TOKEN_STAGE]).start()
+    Watcher(QUEUE, [QUEUE_STAGE]).start()
 
     threading.Thread(target=process_audiofiles, args=()).start()
     logger.info('Started process_audiofiles')
 
+    threading.Thread(target=process_live, args=()).start()
+    logger.info('Started process_live')
+
+    threading.Thread(target=process_storage, args=()).start()
+    logger.info('Started process_storage')
+
+    threading.Thread(target=sync_queue, args=()).start()
     threading.Thread(target=process_queue, args=()).start()
     logger.info('Started process_queue')
 
@@ -2,11 +2,25 @@
 
 import traceback
 import threading
-from pymongo import MongoClient
-from time import sleep
-import configparser
+from datetime import datetime, timezone, timedelta
+from pymongo import MongoClient, ReturnDocument, ASCENDING, DESCENDING, UpdateOne
 import logging.config
+import os
+import psutil
+import re
+import shutil
+import socket
 import subprocess
+from pathlib import Path
+from time import monotonic, sleep
+
+from dispatch import Stage, Watcher
+import metrics
+from metrics import observe_status, RECORDERS
+from notifier import NOTIFIER
+from schema import ensure_indexes
+from settings import SETTINGS
+from storage import over_watermark
 
 LOGGING = {
     'version': 1,
@@ -50,31 +64,375 @@ CLIENT = MongoClient(host='localhost:27017',
                      )
 TASKS = CLIENT['clubhouse']['tasks']
 
+RECORD_STAGE = Stage('start_record', {'GOT_TOKEN'}, poll_interval=5)
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+# Rooms with more subscribers first (see schema.subscribe), then oldest first
+QUEUE_ORDER = [('priority', DESCENDING), ('dt', ASCENDING)]
+
+RUNNING = {}
+RUNNING_LOCK = threading.Lock()
+
 logger = logging.getLogger(__name__)
 
 
+def lease_until():
+    return datetime.now(timezone.utc) + timedelta(seconds=SETTINGS.getint('Recorder', 'lease', fallback=60))
+
+
+def claim_task():
+    """Atomically take one GOT_TOKEN room (or a STARTING one abandoned by a crashed worker).
+
+    DOWNLOADING rooms abandoned the same way go back for a new token in reclaim_expired().
+
+    Returns the task as it was before the claim, so the time spent waiting can be measured.
+    """
+    return TASKS.find_one_and_update({'$or': [{'status': 'GOT_TOKEN'},
+                                              {'status': 'STARTING',
+                                               'lease_until': {'$lt': datetime.now(timezone.utc)}}]},
+                                     {'$set': {'status': 'STARTING',
+                                               'status_dt': datetime.now(timezone.utc),
+                                               'worker': WORKER_ID,
+                                               'lease_until': lease_until()},
+                                      '$unset': {'position': ''}},
+                                     sort=QUEUE_ORDER,
+                                     return_document=ReturnDocument.BEFORE)
+
+
+def renew_lease(room_id):
+    result = TASKS.update_one({'_id': room_id, 'worker': WORKER_ID},
+                              {'$set': {'lease_until': lease_until()}})
+    if not result.matched_count:
+        logger.warning(f'{room_id}: lease lost')
+        return False
+    return True
+
+
+def admit():
+    """Check live load on this host before starting one more recording."""
+    max_recordings = SETTINGS.getint('Recorder', 'max_recordings', fallback=80)
+    max_cpu = SETTINGS.getfloat('Recorder', 'max_cpu', fallback=90)
+    min_free_disk = SETTINGS.getfloat('Recorder', 'min_free_disk_gb', fallback=5) * 1024 ** 3
+    min_free_mem = SETTINGS.getfloat('Recorder', 'min_free_mem_mb', fallback=512) * 1024 ** 2
+
+    if len(RUNNING) >= max_recordings:
+        logger.debug(f'Busy: {len(RUNNING)} recordings running')
+        return False
+    cpu = psutil.cpu_percent()
+    if cpu > max_cpu:
+        logger.debug(f'Busy: CPU {cpu}%')
+        return False
+    free_disk = shutil.disk_usage('records').free
+    if free_disk < min_free_disk:
+        logger.warning(f'Busy: only {free_disk // 1024 ** 2} MB free under records/')
+        return False
+    if over_watermark():
+        logger.warning('Busy: records/ is over the [Storage] high watermark')
+        return False
+    free_mem = psutil.virtual_memory().available
+    if free_mem < min_free_mem:
+        logger.warning(f'Busy: only {free_mem // 1024 ** 2} MB of memory available')
+        return False
+    return True
+
+
+def report_queue():
+    """Store each waiting room's position so the bot can tell users where they are."""
+    updates = [UpdateOne({'_id': task['_id'], 'status': 'GOT_TOKEN'}, {'$set': {'position': position}})
+               for position, task in enumerate(TASKS.find({'status': 'GOT_TOKEN'}, {'_id': 1}).sort(QUEUE_ORDER), 1)]
+    if updates:
+        logger.info(f'{len(updates)} rooms waiting for a recorder')
+        TASKS.bulk_write(updates, ordered=False)
+
+
 def run_cmd(cmd, room_id):
-    proc = subprocess.Popen([cmd], shell=True)
-    TASKS.update_one({'_id': room_id}, {'$set': {'status': 'DOWNLOADING',
-                                                 'pid': proc.pid}})
+    try:
+        if record(cmd, room_id) and not hand_over(room_id):
+            requeue(room_id)
+    finally:
+        with RUNNING_LOCK:
+            RUNNING.pop(room_id, None)
+        RECORD_STAGE.wake()
+
+
+def supervise(proc, room_id):
+    """Renew the lease until the recorder exits. proc is a Popen or an adopted psutil.Process.
+
+    Returns False if the room was taken away meanwhile; the recorder is killed then,
+    whoever owns the room now records it.
+    """
+    renew_every = SETTINGS.getint('Recorder', 'lease', fallback=60) / 3
+    while True:
+        try:
+            proc.wait(timeout=renew_every)
+            return True
+        except (subprocess.TimeoutExpired, psutil.TimeoutExpired):
+            if not renew_lease(room_id):
+                stop(proc, room_id)
+                return False
+
+
+def stop(proc, room_id):
+    logger.warning(f'{room_id}: killing recorder {proc.pid}')
+    try:
+        kill_tree(proc.pid)
+    except psutil.NoSuchProcess:
+        pass
     proc.wait()
 
 
+def adopt(proc, room_id):
+    try:
+        owned = supervise(proc, room_id)
+    except psutil.NoSuchProcess:
+        owned = True
+    try:
+        if owned and not hand_over(room_id):
+            requeue(room_id)
+    finally:
+        with RUNNING_LOCK:
+            RUNNING.pop(room_id, None)
+        RECORD_STAGE.wake()
+
+
+def is_recorder(pid, room_id):
+    try:
+        cmdline = ' '.join(psutil.Process(pid).cmdline())
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return False
+    return 'recorder_local' in cmdline and f'--channel {room_id}' in cmdline
+
+
+def recorded_dirs(room_id):
+    return [d for d in Path('records').glob(f'*/{room_id}_*') if any(d.glob('*.aac'))]
+
+
+def hand_over(room_id):
+    """Make sure a room whose recorder is gone gets delivered. Returns False if nothing was recorded.
+
+    recorder_local only writes the done marker when it exits cleanly; a crashed or killed one
+    leaves a partial recording behind, which is marked done so ch_cron delivers what there is.
+    """
+    directories = recorded_dirs(room_id)
+    if not directories:
+        return False
+    if not any((d / 'recording2-done.txt').exists() for d in directories):
+        directory = max(directories, key=lambda d: d.stat().st_mtime)
+        logger.warning(f'{room_id}: recorder did not finish, delivering the partial recording in {directory}')
+        (directory / 'recording2-done.txt').touch()
+    # Delivery is up to ch_cron now, nobody renews the lease any more
+    TASKS.update_one({'_id': room_id, 'status': 'DOWNLOADING'}, {'$unset': {'lease_until': ''}})
+    return True
+
+
+def requeue(room_id, worker=WORKER_ID, expired_by=None):
+    """Send a room that recorded nothing back for a new token, unless another worker owns it by now.
+
+    With expired_by, only if its lease ran out before then.
+    """
+    logger.warning(f'{room_id}: asking for a new token')
+    query = {'_id': room_id, 'worker': worker}
+    if expired_by:
+        query['lease_until'] = {'$lt': expired_by}
+    TASKS.update_one(query,
+                     {'$set': {'status': 'WAITING_FOR_TOKEN', 'status_dt': datetime.now(timezone.utc)},
+                      '$unset': {'pid': '', 'worker': '', 'lease_until': '', 'token': '', 'samples': '',
+                                 'stalled': '', 'runaway': ''}})
+
+
+def retry_stalled(room_id):
+    """Re-queue a room whose recorder never wrote any audio, fail it after [Recorder] max_stalls tries."""
+    task = TASKS.find_one_and_update({'_id': room_id, 'worker': WORKER_ID},
+                                     {'$inc': {'stalls': 1}},
+                                     return_document=ReturnDocument.AFTER)
+    if task is None:
+        return
+    if task['stalls'] < SETTINGS.getint('Recorder', 'max_stalls', fallback=3):
+        requeue(room_id)
+        return
+    logger.error(f'{room_id}: recorder stalled {task["stalls"]} times without any audio, giving up')
+    TASKS.update_one({'_id': room_id, 'worker': WORKER_ID},
+                     {'$set': {'status': 'FAILED', 'error': 'recorder stalled'},
+                      '$unset': {'pid': '', 'worker': '', 'lease_until': '', 'token': ''}})
+    NOTIFIER.notify(task['users'], f"Room <b>{task.get('topic', room_id)}</b> could not be recorded, we never received any audio. Sorry :(")
+
+
+def reclaim_expired():
+    """Re-queue rooms whose recorder stopped renewing its lease without handing anything over.
+
+    That is a host that crashed and has not come back; its recording, if any, stays on its disk.
+    """
+    now = datetime.now(timezone.utc)
+    for task in TASKS.find({'status': 'DOWNLOADING', 'lease_until': {'$lt': now}}, {'worker': 1}):
+        logger.warning(f'{task["_id"]}: lease of {task.get("worker")} has expired')
+        requeue(task['_id'], task.get('worker'), expired_by=now)
+
+
+def recover():
+    """Re-adopt recorders that outlived a previous ch_recorder on this host, hand the dead ones to delivery."""
+    host = socket.gethostname()
+    for task in TASKS.find({'status': 'DOWNLOADING', 'worker': {'$regex': f'^{re.escape(host)}:'}}):
+        room_id = task['_id']
+        pid = task.get('pid')
+        if pid and is_recorder(pid, room_id):
+            logger.info(f'{room_id}: re-adopting recorder {pid}')
+            TASKS.update_one({'_id': room_id}, {'$set': {'worker': WORKER_ID, 'lease_until': lease_until()}})
+            proc = psutil.Process(pid)
+            with RUNNING_LOCK:
+                RUNNING[room_id] = proc
+            threading.Thread(target=adopt, args=(proc, room_id,)).start()
+            continue
+
+        if hand_over(room_id):
+            logger.info(f'{room_id}: recorder {pid} is gone, leaving the recording for delivery')
+            continue
+        logger.warning(f'{room_id}: recorder {pid} is gone')
+        requeue(room_id, task['worker'])
+
+
+def record(cmd, room_id):
+    proc = subprocess.Popen([cmd], shell=True)
+    with RUNNING_LOCK:
+        RUNNING[room_id] = proc
+    task = TASKS.find_one_and_update({'_id': room_id, 'worker': WORKER_ID},
+                                     {'$set': {'status': 'DOWNLOADING',
+                                               'status_dt': datetime.now(timezone.utc),
+                                               'pid': proc.pid,
+                                               'lease_until': lease_until()}},
+                                     return_document=ReturnDocument.BEFORE)
+    if task is None:
+        logger.warning(f'{room_id}: claim lost before the recorder started')
+        stop(proc, room_id)
+        return False
+    observe_status(task)
+    return supervise(proc, room_id)
+
+
+class RoomSampler:
+    """Resource usage of one recorder_local process tree."""
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.directory = None
+        self.processes = {}
+        self.bytes = 0
+        self.grown = monotonic()
+        self.runaway = False
+
+    def tree(self, pid):
+        parent = psutil.Process(pid)
+        current = {p.pid: p for p in [parent] + parent.children(recursive=True)}
+        # Keep the Process objects we already have, cpu_percent() measures since the previous call
+        self.processes = {pid: self.processes.get(pid, p) for pid, p in current.items()}
+        return self.processes.values()
+
+    def written(self):
+        if self.directory is None:
+            self.directory = next(Path('records').glob(f'*/{self.room_id}_*'), None)
+            if self.directory is None:
+                return 0
+        return sum(f.stat().st_size for f in self.directory.iterdir() if f.is_file())
+
+    def sample(self, pid):
+        cpu = rss = fds = 0
+        for p in self.tree(pid):
+            try:
+                cpu += p.cpu_percent()
+                rss += p.memory_info().rss
+                fds += p.num_fds()
+            except psutil.NoSuchProcess:
+                pass
+        written = self.written()
+        if written > self.bytes:
+            self.bytes = written
+            self.grown = monotonic()
+        return {'dt': datetime.now(timezone.utc), 'cpu': cpu, 'rss': rss, 'fds': fds, 'bytes': written}
+
+
+def kill_tree(pid):
+    parent = psutil.Process(pid)
+    for child in parent.children(recursive=True):
+        child.terminate()
+    parent.terminate()
+
+
+def sample_recordings():
+    """Record CPU, memory, fds and bytes written per recording; kill stalled ones, flag runaways."""
+    samplers = {}
+    while True:
+        interval = SETTINGS.getint('Recorder', 'sample_interval', fallback=30)
+        sleep(interval)
+        stall_timeout = SETTINGS.getint('Recorder', 'stall_timeout', fallback=600)
+        max_rss = SETTINGS.getfloat('Recorder', 'max_rss_mb', fallback=1024) * 1024 ** 2
+        max_cpu = SETTINGS.getfloat('Recorder', 'max_cpu_per_room', fallback=100)
+        max_samples = SETTINGS.getint('Recorder', 'max_samples', fallback=120)
+        with RUNNING_LOCK:
+            running = {room_id: proc.pid for room_id, proc in RUNNING.items() if proc is not None}
+        # Keyed by pid too, so a room re-queued and claimed again starts with a fresh sampler
+        for key in set(samplers) - set(running.items()):
+            del samplers[key]
+        for room_id, pid in running.items():
+            sampler = samplers.setdefault((room_id, pid), RoomSampler(room_id))
+            try:
+                sample = sampler.sample(pid)
+                update = {'$push': {'samples': {'$each': [sample], '$slice': -max_samples}}}
+
+                if not sampler.runaway and (sample['rss'] > max_rss or sample['cpu'] > max_cpu):
+                    logger.warning(f'{room_id}: runaway recorder, {sample["cpu"]}% CPU, {sample["rss"] // 1024 ** 2} MB')
+                    sampler.runaway = True
+                    update['$set'] = {'runaway': True}
+
+                stalled = monotonic() - sampler.grown > stall_timeout
+                if stalled:
+                    logger.error(f'{room_id}: nothing written for {stall_timeout}s, killing {pid}')
+                    update['$set'] = {**update.get('$set', {}), 'stalled': True}
+
+                TASKS.update_one({'_id': room_id}, update)
+                if stalled:
+                    # A partial recording is handed over by run_cmd/adopt once the recorder is gone;
+                    # without one, release the room first so they find nothing left to do
+                    if not recorded_dirs(room_id):
+                        retry_stalled(room_id)
+                    kill_tree(pid)
+            except psutil.NoSuchProcess:
+                continue
+            except:
+                logger.critical(f'sample_recordings {room_id} has broken')
+                print(traceback.format_exc())
+
+
 if __name__ == "__main__":
+    SETTINGS.install_sighup()
+    ensure_indexes(CLIENT['clubhouse'])
+    metrics.start('ch_recorder')
+    RECORDERS.set_function(lambda: len(RUNNING))
+    threading.Thread(target=sample_recordings, daemon=True).start()
+    os.makedirs('records', exist_ok=True)
+    recover()
+    psutil.cpu_percent()
+    Watcher(TASKS, [RECORD_STAGE]).start()
     while True:
-        config = configparser.ConfigParser()
-        config.read('settings.ini')
-        UID = config['Clubhouse']['user_id']
-        sleep(5)
+        UID = SETTINGS['Clubhouse']['user_id']
+        RECORD_STAGE.wait()
         try:
-            for task in TASKS.find({'status': 'GOT_TOKEN'}):
+            while admit():
+                task = claim_task()
+                if task is None:
+                    break
+                observe_status(task)
                 room_id = task['_id']
                 logger.info(f'Recording {room_id}')
                 token = task['token']
+                uid = task.get('uid', UID)
 
-                cmd = f'./recorder_local --channel {room_id} --appId 938de3e8055e42b281bb8c6f69c21f78 --uid {UID} --channelKey {token} --appliteDir bin --isMixingEnabled 1 --isAudioOnly 1 --idle 120 --recordFileRootDir records --logLevel 2'
+                cmd = f'./recorder_local --channel {room_id} --appId 938de3e8055e42b281bb8c6f69c21f78 --uid {uid} --channelKey {token} --appliteDir bin --isMixingEnabled 1 --isAudioOnly 1 --idle 120 --recordFileRootDir records --logLevel 2'
                 logger.info(cmd)
+                with RUNNING_LOCK:
+                    RUNNING[room_id] = None
                 threading.Thread(target=run_cmd, args=(cmd,room_id,)).start()
+            reclaim_expired()
+            report_queue()
         except:
             logger.critical(f'start_record has broken')
             print(traceback.format_exc())
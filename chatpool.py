@@ -0,0 +1,49 @@
+"""Bounded worker pool for Telegram handlers that keeps per-chat ordering.
+
+Updates from different chats run concurrently; updates from the same chat
+run one after another in the order they arrived.
+"""
+
+import functools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ChatExecutor:
+    def __init__(self, workers=8):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, fn, *args):
+        with self._lock:
+            queue = self._queues.get(chat_id)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._queues[chat_id] = deque([(fn, args)])
+        self._pool.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self._lock:
+                queue = self._queues[chat_id]
+                if not queue:
+                    del self._queues[chat_id]
+                    return
+                fn, args = queue.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception(f'{fn.__name__} for {chat_id} has broken')
+
+    def wrap(self, handler):
+        """Turn a handler into one that returns immediately and runs on the pool."""
+        @functools.wraps(handler)
+        def wrapper(update, context):
+            self.submit(update.effective_chat.id, handler, update, context)
+        return wrapper
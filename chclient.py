@@ -0,0 +1,85 @@
+"""Rate-limited Clubhouse API client shared by the bot and the cron.
+
+clubhouse-py opens a new connection for every call. This wrapper reuses its
+authentication headers on one keep-alive requests.Session, paces calls with a
+token bucket shared by all threads and backs off when Clubhouse answers with
+a 'detail' (ban-style) response.
+"""
+
+import logging
+import threading
+from time import monotonic, sleep
+
+import requests
+from clubhouse import Clubhouse
+
+from metrics import API_SECONDS, API_ERRORS
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class ClubhouseClient:
+    def __init__(self, user_id, user_token, user_device, rate=0.2, api_url=Clubhouse.API_URL,
+                 min_backoff=30, max_backoff=3600):
+        self.user_id = user_id
+        self.key = (user_id, user_token, user_device)
+        self.api_url = api_url.rstrip('/')
+        self.headers = dict(Clubhouse(user_id=user_id, user_token=user_token, user_device=user_device).HEADERS)
+        self.headers.pop('Connection', None)
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def _penalize(self, reason):
+        with self._lock:
+            self.backoff = min(self.max_backoff, max(self.min_backoff, self.backoff * 2))
+            self._paused_until = monotonic() + self.backoff
+        logger.warning(f'Clubhouse {reason}, backing off for {self.backoff}s')
+
+    def _recover(self):
+        with self._lock:
+            self.backoff = self.backoff // 2 if self.backoff > self.min_backoff else 0
+
+    def post(self, endpoint, data):
+        self.bucket.acquire()
+        pause = self._paused_until - monotonic()
+        if pause > 0:
+            sleep(pause)
+        try:
+            with API_SECONDS.labels('clubhouse', endpoint).time():
+                response = self.session.post(f'{self.api_url}/{endpoint}', headers=self.headers, json=data, timeout=30)
+                result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            API_ERRORS.labels('clubhouse', endpoint, type(e).__name__).inc()
+            raise
+        if response.status_code == 429 or 'detail' in result:
+            API_ERRORS.labels('clubhouse', endpoint, 'ban' if 'detail' in result else 'throttled').inc()
+            self._penalize(result.get('detail', 'throttled'))
+        else:
+            self._recover()
+        return result
+
+    def get_event(self, event_hashid):
+        return self.post('get_event', {'user_ids': None,
+                                       'club_id': None,
+                                       'is_member_only': False,
+                                       'event_id': None,
+                                       'event_hashid': event_hashid,
+                                       'description': None,
+                                       'time_start_epoch': None,
+                                       'name': None})
+
+    def join_channel(self, channel):
+        return self.post('join_channel', {'channel': channel,
+                                          'attribution_source': 'feed',
+                                          'attribution_details': 'eyJpc19leHBsb3JlIjpmYWxzZSwicmFuayI6MX0='})
+
+    def leave_channel(self, channel):
+        return self.post('leave_channel', {'channel': channel})
+
@@ -0,0 +1,82 @@
+"""Wake pipeline stages from MongoDB change streams instead of fixed sleeps.
+
+Every stage waits on its own event. A watcher thread per collection sets the
+event as soon as a document enters one of the stage's statuses. Change streams
+need a replica set; on a standalone mongod (or mongomock) the watcher gives up
+and the stages simply poll every `poll_interval` seconds.
+"""
+
+import logging
+import threading
+from time import sleep
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# The $changeStream stage is only supported on replica sets
+CHANGE_STREAMS_UNSUPPORTED = {40573, 40324}
+
+
+class Stage:
+    def __init__(self, name, statuses=None, poll_interval=30):
+        self.name = name
+        self.statuses = frozenset(statuses) if statuses else None
+        self.poll_interval = poll_interval
+        self._event = threading.Event()
+        self._event.set()
+
+    def matches(self, doc):
+        return self.statuses is None or doc.get('status') in self.statuses
+
+    def wake(self):
+        self._event.set()
+
+    def wait(self):
+        """Block until woken or the poll interval passes. Returns True if woken."""
+        woken = self._event.wait(self.poll_interval)
+        self._event.clear()
+        return woken
+
+
+class Watcher:
+    def __init__(self, collection, stages):
+        self.collection = collection
+        self.stages = list(stages)
+        self._resume_token = None
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'watch-{self.collection.name}', daemon=True).start()
+        return self
+
+    def _dispatch(self, change):
+        doc = change.get('fullDocument') or change.get('updateDescription', {}).get('updatedFields', {})
+        for stage in self.stages:
+            if stage.matches(doc):
+                logger.debug(f'Waking {stage.name} for {change["documentKey"]["_id"]}')
+                stage.wake()
+
+    def _run(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        while True:
+            try:
+                with self.collection.watch(pipeline,
+                                           full_document='updateLookup',
+                                           resume_after=self._resume_token) as stream:
+                    logger.info(f'Watching {self.collection.name}')
+                    for change in stream:
+                        self._resume_token = stream.resume_token
+                        self._dispatch(change)
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAMS_UNSUPPORTED:
+                    logger.warning(f'No change streams on {self.collection.name}, falling back to polling')
+                    return
+                logger.exception(f'Watching {self.collection.name} has broken')
+                self._resume_token = None
+                sleep(5)
+            except (TypeError, NotImplementedError):
+                logger.warning(f'{self.collection.name} cannot be watched, falling back to polling')
+                return
+            except PyMongoError:
+                logger.exception(f'Watching {self.collection.name} has broken')
+                sleep(5)
@@ -0,0 +1,61 @@
+"""TTL cache in front of Clubhouse get_event, shared by the bot and the cron through Mongo.
+
+Concurrent lookups of the same event inside one process wait for a single API
+call. Entries expire sooner as the event's time_start gets close, so the cron
+still notices the moment a room is opened.
+"""
+
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class EventCache:
+    def __init__(self, collection, fetch, min_ttl=30, max_ttl=3600):
+        self.collection = collection
+        self.fetch = fetch
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def ttl(self, data):
+        ev = data['event']
+        if ev.get('channel') or ev.get('is_expired'):
+            return self.max_ttl
+        until = (datetime.fromisoformat(ev['time_start']).astimezone(timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+        return max(self.min_ttl, min(self.max_ttl, until / 10))
+
+    def get(self, event_hashid):
+        cached = self.collection.find_one({'_id': event_hashid, 'expire_at': {'$gt': datetime.now(timezone.utc)}})
+        if cached:
+            logger.debug(f'{event_hashid} from cache')
+            return cached['data']
+
+        with self._lock:
+            future = self._inflight.get(event_hashid)
+            owner = future is None
+            if owner:
+                future = self._inflight[event_hashid] = Future()
+        if not owner:
+            logger.debug(f'Waiting for the get_event already running for {event_hashid}')
+            return future.result()
+
+        try:
+            data = self.fetch(event_hashid)
+            if data.get('success'):
+                expire_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl(data))
+                self.collection.replace_one({'_id': event_hashid},
+                                            {'data': data, 'expire_at': expire_at},
+                                            upsert=True)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[event_hashid]
@@ -0,0 +1,50 @@
+"""Prometheus metrics shared by ch_bot.py, ch_cron.py and ch_recorder.py.
+
+Each process serves its own registry on a local port, see start().
+"""
+
+import logging
+from datetime import datetime, timezone
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'ch_bot': 9101, 'ch_cron': 9102, 'ch_recorder': 9103}
+
+STATUS_SECONDS = Histogram('clubhouse_task_status_seconds', 'Time a task spent in a pipeline status', ['status'],
+                           buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 28800))
+FFMPEG_SECONDS = Histogram('clubhouse_ffmpeg_seconds', 'ffmpeg run time', ['job'],
+                           buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 2400, 3600))
+FFMPEG_REALTIME = Histogram('clubhouse_ffmpeg_realtime_factor', 'Seconds of audio processed per second of ffmpeg',
+                            buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+UPLOAD_BYTES = Counter('clubhouse_upload_bytes', 'Bytes uploaded to Telegram')
+UPLOAD_SPEED = Histogram('clubhouse_upload_bytes_per_second', 'Upload speed of a single file to Telegram',
+                         buckets=(64e3, 256e3, 1e6, 4e6, 16e6, 64e6))
+API_SECONDS = Histogram('clubhouse_api_seconds', 'External API call latency', ['api', 'method'])
+API_ERRORS = Counter('clubhouse_api_errors', 'External API errors by class', ['api', 'method', 'error'])
+RECORDERS = Gauge('clubhouse_recorders', 'Live recorder_local processes')
+ROOMS_DELIVERED = Counter('clubhouse_rooms_delivered', 'Rooms delivered to subscribers')
+RECORDS_BYTES = Gauge('clubhouse_records_bytes', 'Disk used by recordings and their parts')
+TRIMMED_SECONDS = Counter('clubhouse_trimmed_seconds', 'Seconds of silence cut before encoding', ['profile'])
+TRIMMED_BYTES = Counter('clubhouse_trimmed_bytes', 'Estimated bytes not encoded or uploaded thanks to silence trimming', ['profile'])
+
+
+def start(name):
+    port = SETTINGS.getint('Metrics', f'{name}_port', fallback=DEFAULT_PORTS[name])
+    if not port:
+        return
+    start_http_server(port, addr=SETTINGS.get('Metrics', 'listen', fallback='127.0.0.1'))
+    logger.info(f'Metrics on port {port}')
+
+
+def observe_status(task):
+    """Record how long `task` has been in its current status."""
+    since = task.get('status_dt') or task.get('dt')
+    if since is None:
+        return
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    STATUS_SECONDS.labels(task['status']).observe((datetime.now(timezone.utc) - since).total_seconds())
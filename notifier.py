@@ -0,0 +1,170 @@
+"""Single pooled Telegram Bot client with rate-aware fan-out.
+
+Telegram allows roughly 30 messages per second per bot and about one message
+per second per chat. Every send goes through both limits here, and 429
+retry_after, Unauthorized and timeouts are handled in one place.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+from time import monotonic, sleep
+
+import telegram
+from telegram.utils.request import Request
+
+from metrics import API_SECONDS, API_ERRORS, UPLOAD_BYTES, UPLOAD_SPEED
+from ratelimit import TokenBucket, KeyedInterval
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Returned instead of a message when the chat will never accept one: the bot was blocked or the chat is gone
+GONE = object()
+
+
+def bot_urls():
+    """base_url/base_file_url for a self-hosted telegram-bot-api server set as [Telegram] base_url."""
+    base_url = SETTINGS.get('Telegram', 'base_url')
+    if not base_url:
+        return {}
+    base_url = base_url.rstrip('/')
+    return {'base_url': f'{base_url}/bot', 'base_file_url': f'{base_url}/file/bot'}
+
+
+def local_mode():
+    """A local server started with --local reads files straight from our disk."""
+    return bool(SETTINGS.get('Telegram', 'base_url')) and SETTINGS.getboolean('Telegram', 'local_mode', fallback=False)
+
+
+def upload_limit():
+    """Largest file we may send, in bytes: 50 MB through api.telegram.org, 2000 MB to a local server."""
+    return SETTINGS.getfloat('Telegram', 'upload_limit_mb', fallback=2000 if local_mode() else 50) * 1000 * 1000
+
+
+def part_size():
+    """Size parts are cut to, in bytes, leaving room under upload_limit() for bitrate variation."""
+    return SETTINGS.getfloat('Audio', 'part_size_mb', fallback=1900 if local_mode() else 45) * 1000 * 1000
+
+
+class Notifier:
+    def __init__(self, workers=8, retries=3):
+        self.workers = workers
+        self.retries = retries
+        self._bot = None
+        self._token = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='notifier')
+        self._global = TokenBucket(SETTINGS.getfloat('Telegram', 'global_rate', fallback=25))
+        self._per_chat = KeyedInterval(SETTINGS.getfloat('Telegram', 'chat_interval', fallback=1))
+
+    @property
+    def bot(self) -> telegram.Bot:
+        token = (SETTINGS['Telegram']['token'], SETTINGS.get('Telegram', 'base_url'))
+        with self._lock:
+            if self._bot is None or token != self._token:
+                request = Request(con_pool_size=self.workers + 4,
+                                  connect_timeout=10,
+                                  read_timeout=SETTINGS.getfloat('Telegram', 'read_timeout', fallback=120))
+                self._bot = telegram.Bot(token[0], request=request, **bot_urls())
+                self._token = token
+            return self._bot
+
+    def _call(self, chat_id, method, **kwargs):
+        """Returns the message, GONE for chats that are lost for good, or None if sending failed for now."""
+        for attempt in range(1, self.retries + 1):
+            self._per_chat.wait(chat_id)
+            self._global.acquire()
+            for value in kwargs.values():
+                if hasattr(value, 'seek'):
+                    value.seek(0)
+            try:
+                with API_SECONDS.labels('telegram', method).time():
+                    return getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+            except telegram.error.TelegramError as e:
+                API_ERRORS.labels('telegram', method, type(e).__name__).inc()
+                if isinstance(e, telegram.error.RetryAfter):
+                    logger.warning(f'Flood control for {chat_id}, retry in {e.retry_after}s')
+                    sleep(e.retry_after)
+                elif isinstance(e, telegram.error.Unauthorized):
+                    logger.warning(f'{chat_id} banned the bot!')
+                    return GONE
+                elif isinstance(e, telegram.error.BadRequest):
+                    if 'chat not found' in e.message.lower():
+                        logger.warning(f'{chat_id} does not exist anymore')
+                        return GONE
+                    logger.error(f'{method} to {chat_id} failed: {e}')
+                    return None
+                elif isinstance(e, telegram.error.NetworkError):
+                    # Timeouts, connection resets, 5xx from Telegram
+                    logger.warning(f'{method} to {chat_id} failed: {e} ({attempt}/{self.retries})')
+                    sleep(attempt * 5)
+                else:
+                    logger.error(f'{method} to {chat_id} failed: {e}')
+                    return None
+        logger.error(f'{method} to {chat_id} gave up after {self.retries} attempts')
+        return None
+
+    def _fan_out(self, users, fn, *args, **kwargs):
+        """Run fn(user, ...) for every user concurrently.
+
+        Returns {user: message} for successes and {user: GONE} for lost chats; users that failed for now are left out.
+        """
+        futures = {user: self._pool.submit(fn, user, *args, **kwargs) for user in users}
+        sent = {}
+        for user, future in futures.items():
+            try:
+                message = future.result()
+            except Exception:
+                logger.exception(f'Sending to {user} has broken')
+                continue
+            if message is not None:
+                sent[user] = message
+        return sent
+
+    def notify(self, users, text, parse_mode='html'):
+        return self._fan_out(users, self._call, 'send_message', text=text, parse_mode=parse_mode)
+
+    def _send_file(self, user, path, method, field, **kwargs):
+        if local_mode():
+            # The server opens the file itself, nothing goes through this process and there is no upload to measure
+            return self._call(user, method, **{field: Path(path).absolute().as_uri()}, **kwargs)
+        started = monotonic()
+        with open(path, 'rb') as f:
+            message = self._call(user, method, **{field: f}, **kwargs)
+        if message is not None and message is not GONE:
+            size = os.path.getsize(path)
+            UPLOAD_BYTES.inc(size)
+            UPLOAD_SPEED.observe(size / max(monotonic() - started, 0.001))
+        return message
+
+    def send_file(self, users, path, field, file_id=None, **kwargs):
+        """Upload `path` once with send_<field> and re-send the returned file_id to everyone else.
+
+        Returns (file_id, {user: message or GONE}), see _fan_out(). Pass a known file_id to skip the upload.
+        """
+        method = f'send_{field}'
+        pending = list(users)
+        sent = {}
+        while file_id is None and pending:
+            user = pending.pop(0)
+            message = self._send_file(user, path, method, field, **kwargs)
+            if message is GONE:
+                sent[user] = GONE
+            elif message is not None:
+                sent[user] = message
+                file_id = getattr(message, field).file_id
+                logger.info(f'Uploaded {path} as {file_id}')
+        if file_id is not None:
+            sent.update(self._fan_out(pending, self._call, method, **{field: file_id}, **kwargs))
+        return file_id, sent
+
+    def send_audio(self, users, path, title, file_id=None):
+        return self.send_file(users, path, 'audio', file_id, title=title)
+
+    def send_voice(self, users, path, caption, file_id=None):
+        return self.send_file(users, path, 'voice', file_id, caption=caption)
+
+NOTIFIER = Notifier()
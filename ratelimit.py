@@ -0,0 +1,47 @@
+"""Thread-safe rate limiters shared by the Telegram and Clubhouse clients."""
+
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """Allow `rate` calls per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                delay = (tokens - self._tokens) / self.rate
+            sleep(delay)
+
+
+class KeyedInterval:
+    """Keep at least `interval` seconds between calls sharing the same key."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, key):
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next.get(key, now))
+            self._next[key] = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
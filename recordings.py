@@ -0,0 +1,118 @@
+"""In-memory index of recorder_local output under records/, kept current with inotify.
+
+recorder_local writes records/<date>/<room_id>_<time>/ and drops
+recording2-done.txt there when the room is over. Instead of globbing the
+whole tree for every task, one thread watches the date and room directories
+and puts a room on `ready` as soon as its done marker appears. A scan on
+start() picks up everything created while nobody was watching.
+"""
+
+import logging
+import queue
+import threading
+from pathlib import Path
+
+from inotify_simple import INotify, flags
+
+logger = logging.getLogger(__name__)
+
+DONE_MARKER = 'recording2-done.txt'
+
+DIR_MASK = flags.CREATE | flags.MOVED_TO | flags.ONLYDIR
+ROOM_MASK = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.ONLYDIR
+
+
+class RecordingIndex:
+    def __init__(self, root='records'):
+        self.root = Path(root)
+        self.ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._finished = set()
+        self._watches = {}
+        self._inotify = INotify()
+
+    def directory(self, room_id):
+        with self._lock:
+            return self._rooms.get(room_id)
+
+    def finished(self):
+        with self._lock:
+            return list(self._finished)
+
+    def forget(self, room_id):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._finished.discard(room_id)
+
+    def start(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._watch(self.root, DIR_MASK)
+        for date_dir in self.root.iterdir():
+            if date_dir.is_dir():
+                self._add_date(date_dir)
+        logger.info(f'Indexed {len(self._rooms)} recordings, {len(self._finished)} finished')
+        threading.Thread(target=self._run, name='recordings', daemon=True).start()
+        return self
+
+    def _watch(self, path, mask):
+        try:
+            self._watches[self._inotify.add_watch(path, mask)] = path
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            logger.exception(f'Cannot watch {path}, raise fs.inotify.max_user_watches')
+            return False
+
+    def _add_date(self, path):
+        # Watch first, then list, so nothing created in between is missed
+        if self._watch(path, DIR_MASK):
+            for room_dir in path.iterdir():
+                if room_dir.is_dir():
+                    self._add_room(room_dir)
+
+    def _add_room(self, path):
+        room_id = path.name.partition('_')[0]
+        with self._lock:
+            self._rooms[room_id] = path
+        if self._watch(path, ROOM_MASK) and (path / DONE_MARKER).exists():
+            self._finish(room_id, path)
+
+    def _finish(self, room_id, path):
+        with self._lock:
+            if room_id in self._finished or self._rooms.get(room_id) != path:
+                return
+            self._finished.add(room_id)
+        logger.info(f'{room_id} seems to be ready')
+        self.ready.put(room_id)
+
+    def _dispatch(self, event):
+        parent = self._watches.get(event.wd)
+        if parent is None:
+            return
+        if event.mask & flags.IGNORED:
+            del self._watches[event.wd]
+            room_id = parent.name.partition('_')[0]
+            with self._lock:
+                if self._rooms.get(room_id) == parent:
+                    del self._rooms[room_id]
+                    self._finished.discard(room_id)
+            return
+        path = parent / event.name
+        if parent == self.root:
+            if event.mask & flags.ISDIR:
+                self._add_date(path)
+        elif parent.parent == self.root:
+            if event.mask & flags.ISDIR:
+                self._add_room(path)
+        elif event.name == DONE_MARKER:
+            self._finish(parent.name.partition('_')[0], parent)
+
+    def _run(self):
+        while True:
+            try:
+                for event in self._inotify.read():
+                    self._dispatch(event)
+            except Exception:
+                logger.exception('Watching recordings has broken')
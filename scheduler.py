@@ -0,0 +1,71 @@
+"""In-memory schedule of queued events, ordered by the time they have to be checked."""
+
+import heapq
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class EventScheduler:
+    def __init__(self, lead=timedelta(minutes=20)):
+        self.lead = lead
+        self._heap = []
+        self._check_at = {}
+        self._running = set()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._check_at)
+
+    def add(self, event_id, time_start=None, check_at=None):
+        """Schedule a check `lead` before time_start, or at an explicit check_at."""
+        if check_at is None:
+            check_at = time_start - self.lead
+        with self._cond:
+            self._check_at[event_id] = check_at
+            heapq.heappush(self._heap, (check_at, event_id))
+            self._cond.notify()
+
+    def load(self, collection, horizon=timedelta(days=1)):
+        """Replace the schedule with a range query on the indexed time_start."""
+        until = datetime.now(timezone.utc) + horizon + self.lead
+        events = {task['_id']: task['time_start'] - self.lead
+                  for task in collection.find({'time_start': {'$lt': until}}, {'time_start': 1}).sort('time_start')}
+        with self._cond:
+            # Keep rechecks that were pushed later than the default check time,
+            # and never hand out an event that is being checked right now
+            for event_id in list(events):
+                if event_id in self._check_at:
+                    events[event_id] = max(events[event_id], self._check_at[event_id])
+                elif event_id in self._running:
+                    del events[event_id]
+            self._check_at = events
+            self._heap = [(check_at, event_id) for event_id, check_at in events.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+        logger.debug(f'{len(events)} events scheduled')
+
+    def due(self):
+        """Block until at least one event is due and return the due event ids.
+
+        Every returned id must be handed back with done() once it has been checked.
+        """
+        with self._cond:
+            while True:
+                now = datetime.now(timezone.utc)
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    check_at, event_id = heapq.heappop(self._heap)
+                    if self._check_at.get(event_id) == check_at:
+                        del self._check_at[event_id]
+                        due.append(event_id)
+                if due:
+                    self._running.update(due)
+                    return due
+                self._cond.wait((self._heap[0][0] - now).total_seconds() if self._heap else None)
+
+    def done(self, event_id):
+        with self._cond:
+            self._running.discard(event_id)
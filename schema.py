@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+"""Indexes for the tasks and queue collections.
+
+Every entry point calls ensure_indexes() on startup. Run this file directly to
+create the indexes and check that the hot queries are served by them.
+"""
+
+import logging
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+
+def subscribe(tasks, room_id, users):
+    """Add users to a task. Its priority, the number of subscribers, is kept in step so the
+    recorder queue serves the most wanted rooms first."""
+    return tasks.update_one({'_id': room_id},
+                            [{'$set': {'users': {'$setUnion': [{'$ifNull': ['$users', []]}, users]}}},
+                             {'$set': {'priority': {'$size': '$users'}}}])
+
+
+def task_indexes():
+    return [
+        IndexModel([('status', ASCENDING), ('dt', ASCENDING)], name='status_dt'),
+        IndexModel([('status', ASCENDING), ('users', ASCENDING)], name='status_users'),
+        IndexModel([('status', ASCENDING), ('priority', DESCENDING), ('dt', ASCENDING)], name='status_priority_dt'),
+        # Stale or abandoned tasks disappear on their own
+        IndexModel([('dt', ASCENDING)], name='dt_ttl',
+                   expireAfterSeconds=SETTINGS.getint('Mongo', 'task_ttl', fallback=7 * 24 * 3600)),
+    ]
+
+
+def queue_indexes():
+    return [
+        IndexModel([('time_start', ASCENDING)], name='time_start_ttl',
+                   expireAfterSeconds=SETTINGS.getint('Mongo', 'queue_ttl', fallback=24 * 3600)),
+    ]
+
+
+def event_indexes():
+    return [
+        IndexModel([('expire_at', ASCENDING)], name='expire_at_ttl', expireAfterSeconds=0),
+    ]
+
+
+def ensure_indexes(db):
+    for collection, indexes in ((db['tasks'], task_indexes()),
+                                (db['queue'], queue_indexes()),
+                                (db['events'], event_indexes())):
+        try:
+            collection.create_indexes(indexes)
+        except OperationFailure as e:
+            # Usually an index with the same name but different options, e.g. a changed TTL
+            logger.warning(f'Could not create indexes on {collection.name}: {e}')
+
+
+def hot_queries(db):
+    return {
+        'tasks by status': db['tasks'].find({'status': 'DOWNLOADING'}),
+        'recorder queue': db['tasks'].find({'status': 'GOT_TOKEN'}).sort([('priority', DESCENDING), ('dt', ASCENDING)]),
+        'tasks by user': db['tasks'].find({'status': 'DOWNLOADING', 'users': 0}),
+        'due events': db['queue'].find({'time_start': {'$lt': datetime.now(timezone.utc)}}).sort('time_start'),
+    }
+
+
+def plan_stages(plan):
+    yield plan['stage']
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+def explain_check(db):
+    """Return {query name: winning plan stages}; raise if any hot query scans a whole collection."""
+    plans = {}
+    for name, cursor in hot_queries(db).items():
+        stages = list(plan_stages(cursor.explain()['queryPlanner']['winningPlan']))
+        plans[name] = stages
+        if 'COLLSCAN' in stages:
+            raise AssertionError(f'{name} is not served by an index: {stages}')
+    return plans
+
+
+if __name__ == '__main__':
+    from pymongo import MongoClient
+
+    logging.basicConfig(level=logging.INFO)
+    db = MongoClient(host='localhost:27017', tz_aware=True)['clubhouse']
+    ensure_indexes(db)
+    for name, stages in explain_check(db).items():
+        print(f'{name}: {" <- ".join(stages)}')
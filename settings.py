@@ -0,0 +1,102 @@
+"""Shared settings.ini cache for ch_bot.py, ch_cron.py and ch_recorder.py.
+
+The file is parsed once and re-read only when its mtime changes (or on SIGHUP),
+so changes written by the /auth conversation are picked up without a restart.
+"""
+
+import configparser
+import logging
+import os
+import signal
+import stat
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Settings:
+    def __init__(self, path='settings.ini'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._config = configparser.ConfigParser()
+        self._white_list = frozenset()
+        self._stamp = None
+        self._stale = True
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self, stamp):
+        config = configparser.ConfigParser()
+        config.read(self.path)
+        white_list = frozenset(uid.strip()
+                               for uid in config.get('Telegram', 'white_list', fallback='').split(',')
+                               if uid.strip())
+        self._config, self._white_list, self._stamp = config, white_list, stamp
+        self._stale = False
+        logger.info(f'Loaded {self.path}')
+
+    @property
+    def config(self) -> configparser.ConfigParser:
+        stamp = self._stat()
+        if self._stale or stamp != self._stamp:
+            with self._lock:
+                if self._stale or stamp != self._stamp:
+                    self._load(stamp)
+        return self._config
+
+    @property
+    def white_list(self) -> frozenset:
+        self.config
+        return self._white_list
+
+    def is_allowed(self, chat_id) -> bool:
+        return str(chat_id) in self.white_list
+
+    def __getitem__(self, section):
+        return self.config[section]
+
+    def get(self, section, option, fallback=None):
+        return self.config.get(section, option, fallback=fallback)
+
+    def getint(self, section, option, fallback=None):
+        return self.config.getint(section, option, fallback=fallback)
+
+    def getfloat(self, section, option, fallback=None):
+        return self.config.getfloat(section, option, fallback=fallback)
+
+    def getboolean(self, section, option, fallback=None):
+        return self.config.getboolean(section, option, fallback=fallback)
+
+    def reload(self):
+        """Force a re-read on the next access."""
+        self._stale = True
+
+    def update(self, section, values):
+        """Replace a section and write the file atomically."""
+        current = self.config
+        with self._lock:
+            config = configparser.ConfigParser()
+            config.read_dict(current)
+            config[section] = values
+            tmp = f'{self.path}.tmp'
+            # The file holds tokens: never readable by others while written, then keep the mode it had
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as configfile:
+                config.write(configfile)
+            try:
+                os.chmod(tmp, stat.S_IMODE(os.stat(self.path).st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, self.path)
+            self._stale = True
+
+    def install_sighup(self):
+        """Reload on SIGHUP. Must be called from the main thread."""
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+
+
+SETTINGS = Settings()
@@ -0,0 +1,85 @@
+"""Disk space for recordings: usage per room, an admission watermark, scratch space and orphan cleanup.
+
+recorder_local writes records/<date>/<room_id>_<time>/. Parts and other intermediates go to
+[Storage] scratch/<room_id> when set (e.g. a tmpfs), otherwise next to the recording.
+Anything whose room has no task left, or only a FAILED one, is removed by sweep().
+"""
+
+import logging
+import os
+import shutil
+from pathlib import Path
+from time import time
+
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+RECORDS = Path('records')
+
+
+def usage(path):
+    """Bytes taken by the files under `path`."""
+    total = 0
+    for entry in os.scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += usage(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def over_watermark(path=RECORDS):
+    """True once the volume holding `path` is more than [Storage] high_watermark percent full."""
+    disk = shutil.disk_usage(path)
+    used = (disk.total - disk.free) * 100 / disk.total
+    return used >= SETTINGS.getfloat('Storage', 'high_watermark', fallback=90)
+
+
+def scratch_dir(room_id, directory):
+    """Where to put a room's parts: [Storage] scratch/<room_id>, or the recording directory itself."""
+    scratch = SETTINGS.get('Storage', 'scratch')
+    if not scratch:
+        return Path(directory)
+    path = Path(scratch) / str(room_id)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def room_dirs():
+    """Yield (room_id, path) for every room directory under records/ and the scratch area."""
+    for date_dir in RECORDS.iterdir():
+        if date_dir.is_dir():
+            for path in date_dir.iterdir():
+                if path.is_dir():
+                    yield path.name.partition('_')[0], path
+    scratch = SETTINGS.get('Storage', 'scratch')
+    if scratch and os.path.isdir(scratch):
+        for path in Path(scratch).iterdir():
+            if path.is_dir():
+                yield path.name, path
+
+
+def sweep(tasks):
+    """Remove directories of rooms that are gone or FAILED, return {room_id: bytes} for the rest.
+
+    Directories modified less than [Storage] orphan_age seconds ago are left alone.
+    """
+    min_age = SETTINGS.getint('Storage', 'orphan_age', fallback=3600)
+    statuses = {task['_id']: task['status'] for task in tasks.find({}, {'status': 1})}
+    rooms = {}
+    for room_id, path in room_dirs():
+        if statuses.get(room_id, 'FAILED') == 'FAILED':
+            if time() - path.stat().st_mtime > min_age:
+                size = usage(path)
+                logger.warning(f'{room_id}: removing orphaned {path}, {size // 1024 ** 2} MB')
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+        rooms[room_id] = rooms.get(room_id, 0) + usage(path)
+    for date_dir in RECORDS.iterdir():
+        if date_dir.is_dir() and not any(date_dir.iterdir()) and time() - date_dir.stat().st_mtime > min_age:
+            date_dir.rmdir()
+    return rooms
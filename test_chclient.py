@@ -0,0 +1,115 @@
+"""ClubhouseClient against a local HTTP stub: pacing, backoff on 'detail' answers and recovery."""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+import pytest
+
+import chclient
+from chclient import ClubhouseClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.calls.append((self.path, json.loads(body), monotonic()))
+        answer = self.server.answers.pop(0) if self.server.answers else {'success': True}
+        payload = json.dumps(answer).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.calls = []
+    server.answers = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(server, rate=100, min_backoff=30, max_backoff=3600):
+    return ClubhouseClient('1', 'token', 'device', rate=rate,
+                           api_url=f'http://127.0.0.1:{server.server_port}/api/',
+                           min_backoff=min_backoff, max_backoff=max_backoff)
+
+
+@pytest.fixture
+def pauses(monkeypatch):
+    """Backoff pauses the client would have slept; they advance its clock instead of sleeping."""
+    slept = []
+    clock = [monotonic()]
+
+    def sleep(seconds):
+        slept.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(chclient, 'sleep', sleep)
+    monkeypatch.setattr(chclient, 'monotonic', lambda: clock[0])
+    return slept
+
+
+def test_get_event_posts_to_api_url(server):
+    client = make_client(server)
+    assert client.get_event('abc') == {'success': True}
+    path, data, _ = server.calls[0]
+    assert path == '/api/get_event'
+    assert data['event_hashid'] == 'abc'
+
+
+def test_calls_are_paced_by_the_token_bucket(server):
+    client = make_client(server, rate=10)
+    started = monotonic()
+    for _ in range(4):
+        client.post('get_event', {})
+    # The first call spends the only token, the next three wait 0.1s each
+    assert monotonic() - started >= 0.29
+    times = [t for _, _, t in server.calls]
+    assert all(b - a >= 0.08 for a, b in zip(times, times[1:]))
+
+
+def test_backoff_grows_on_detail_and_is_capped(server, pauses):
+    client = make_client(server, min_backoff=30, max_backoff=100)
+    server.answers = [{'detail': 'banned'}] * 4
+
+    client.post('get_event', {})
+    assert client.backoff == 30
+    client.post('get_event', {})
+    assert client.backoff == 60
+    client.post('get_event', {})
+    assert client.backoff == 100
+    client.post('get_event', {})
+    assert client.backoff == 100
+
+    # Every call after a ban waited for the backoff set by the previous one
+    assert [round(p) for p in pauses] == [30, 60, 100]
+
+
+def test_backoff_recovers_after_success(server, pauses):
+    client = make_client(server, min_backoff=30, max_backoff=3600)
+    server.answers = [{'detail': 'banned'}] * 3
+
+    for _ in range(3):
+        client.post('get_event', {})
+    assert client.backoff == 120
+
+    assert client.post('get_event', {}) == {'success': True}
+    assert client.backoff == 60
+    client.post('get_event', {})
+    assert client.backoff == 30
+    client.post('get_event', {})
+    assert client.backoff == 0
+
+    pauses.clear()
+    client.post('get_event', {})
+    assert pauses == []
@@ -0,0 +1,268 @@
+"""ffmpeg helpers that turn a finished recording into parts ready for Telegram."""
+
+import json
+import logging
+import math
+import os
+import subprocess
+import threading
+from pathlib import Path
+from time import monotonic
+
+from metrics import FFMPEG_SECONDS, FFMPEG_REALTIME
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# bitrate is what parts are sized by, None means the bitrate of the recording itself.
+# send is the Bot API method the parts go out with.
+PROFILES = {
+    'speech-opus-24k': {'ext': 'ogg', 'format': 'ogg', 'bitrate': 24000, 'send': 'voice',
+                        'args': ['-c:a', 'libopus', '-b:a', '24k', '-ac', '1', '-application', 'voip']},
+    'mp3-64k': {'ext': 'mp3', 'format': 'mp3', 'bitrate': 64000, 'send': 'audio',
+                'args': ['-c:a', 'libmp3lame', '-b:a', '64k', '-ac', '1']},
+    'mp3-128k': {'ext': 'mp3', 'format': 'mp3', 'bitrate': 128000, 'send': 'audio',
+                 'args': ['-c:a', 'libmp3lame', '-b:a', '128k']},
+    'original': {'ext': 'm4a', 'format': 'ipod', 'bitrate': None, 'send': 'audio', 'copy': True,
+                 'args': ['-c', 'copy', '-bsf:a', 'aac_adtstoasc'], 'options': 'movflags=+faststart'},
+}
+
+
+def default_profile():
+    """[Audio] profile, or 'original' for the older [Audio] format = m4a."""
+    fallback = 'original' if SETTINGS.get('Audio', 'format', fallback='mp3') == 'm4a' else 'mp3-128k'
+    profile = SETTINGS.get('Audio', 'profile', fallback=fallback)
+    if profile not in PROFILES:
+        logger.error(f'Unknown [Audio] profile {profile}, using {fallback}')
+        return fallback
+    return profile
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def silence_filter(profile):
+    """silenceremove settings from [Audio], or None if trimming is off or the profile copies the stream.
+
+    Every silence longer than silence_min seconds below silence_db is cut down to silence_keep seconds.
+    """
+    if not SETTINGS.getboolean('Audio', 'trim_silence', fallback=False) or PROFILES[profile].get('copy'):
+        return None
+    threshold = SETTINGS.getfloat('Audio', 'silence_db', fallback=-50)
+    duration = SETTINGS.getfloat('Audio', 'silence_min', fallback=2)
+    keep = SETTINGS.getfloat('Audio', 'silence_keep', fallback=0.5)
+    return f'silenceremove=stop_periods=-1:stop_duration={duration}:stop_threshold={threshold}dB:stop_silence={keep}'
+
+
+def run_ffmpeg(args, timeout, job='transcode'):
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', *args]
+    logger.info(' '.join(cmd))
+    try:
+        with FFMPEG_SECONDS.labels(job).time():
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TranscodeError(f'ffmpeg timed out after {timeout}s')
+    if result.returncode:
+        raise TranscodeError(f'ffmpeg exited with {result.returncode}: {result.stderr.decode(errors="replace")[-500:]}')
+
+
+def probe(filename, timeout=60):
+    """Return (duration in seconds, bitrate in bits per second) as reported by ffprobe."""
+    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration,bit_rate', '-of', 'json', str(filename)]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TranscodeError(f'ffprobe timed out on {filename}')
+    if result.returncode:
+        raise TranscodeError(f'ffprobe exited with {result.returncode}: {result.stderr.decode(errors="replace")[-500:]}')
+    fmt = json.loads(result.stdout)['format']
+    duration = float(fmt.get('duration') or 0)
+    bitrate = float(fmt.get('bit_rate') or 0)
+    if not bitrate and duration:
+        bitrate = os.path.getsize(filename) * 8 / duration
+    return duration, bitrate
+
+
+def segment_time(duration, bitrate, target_size):
+    """Split `duration` into the fewest equal parts that stay under `target_size` bytes at `bitrate`."""
+    if not bitrate:
+        raise TranscodeError('Cannot size parts without a bitrate')
+    max_time = max(1, math.floor(target_size * 8 / bitrate))
+    if not duration:
+        return max_time
+    parts = max(1, math.ceil(duration / max_time))
+    return min(max_time, math.ceil(duration / parts))
+
+
+def ensure_size(parts, limit, timeout):
+    """Re-split every part that is over `limit` bytes, keeping the order of the parts."""
+    result = []
+    for part in parts:
+        size = os.path.getsize(part)
+        if size <= limit:
+            result.append(part)
+            continue
+        duration, _ = probe(part)
+        if not duration:
+            raise TranscodeError(f'{part} is {size} bytes, but ffprobe reports no duration to split it by')
+        seg = segment_time(duration, size * 8 / duration, limit * 0.9)
+        logger.warning(f'{part} is {size} bytes, re-splitting every {seg}s')
+        stem, ext = os.path.splitext(part)
+        run_ffmpeg(['-i', part, '-c', 'copy',
+                    '-f', 'segment', '-segment_time', str(seg), '-reset_timestamps', '1',
+                    f'{stem}_%03d{ext}'], timeout, job='resplit')
+        os.remove(part)
+        result.extend(ensure_size(sorted(str(p) for p in Path(part).parent.glob(f'{Path(stem).name}_*{ext}')),
+                                  limit, timeout))
+    return result
+
+
+def transcode(filename, directory, name, target_size, limit, timeout, profile='mp3-128k', silence=None):
+    """Encode with `profile` and split into parts in a single ffmpeg pass. Returns the sorted part paths.
+
+    The segment length is derived from the probed duration so that every part stays under
+    `target_size` bytes; any part that still ends up over `limit` is split again.
+    `silence` is an audio filter applied before encoding, see silence_filter().
+    """
+    settings = PROFILES[profile]
+    duration, bitrate = probe(filename)
+    seg = segment_time(duration, settings['bitrate'] or bitrate, target_size)
+    logger.info(f'{filename}: {duration:.0f}s, {profile}, splitting every {seg}s')
+    prefix = f'{name}_{profile}_part_'
+    # Leftovers of an earlier attempt would be picked up as parts
+    for old in Path(directory).glob(f'{prefix}*.{settings["ext"]}'):
+        old.unlink()
+    args = ['-i', str(filename), '-vn', *(['-af', silence] if silence else []), *settings['args'],
+            '-f', 'segment', '-segment_format', settings['format']]
+    if 'options' in settings:
+        args += ['-segment_format_options', settings['options']]
+    args += ['-segment_time', str(seg), '-reset_timestamps', '1', f'{directory}/{prefix}%03d.{settings["ext"]}']
+    started = monotonic()
+    run_ffmpeg(args, timeout, job='remux' if settings.get('copy') else 'transcode')
+    FFMPEG_REALTIME.observe(duration / max(monotonic() - started, 0.001))
+    parts = sorted(str(p) for p in Path(directory).glob(f'{prefix}*.{settings["ext"]}'))
+    if not parts:
+        raise TranscodeError(f'ffmpeg produced no parts for {filename}')
+    return ensure_size(parts, limit, timeout)
+
+
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+
+
+class AdtsTail:
+    """Follow a growing ADTS AAC file and find segment boundaries on complete frames."""
+
+    def __init__(self, filename, offset=0, samples=0):
+        self.filename = str(filename)
+        self.offset = offset
+        self.samples = samples
+        self.sample_rate = None
+
+    def cuts(self, segment_time):
+        """Scan frames appended since the last call; return the byte offsets where a segment fills up."""
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        cuts = []
+        pos = 0
+        while pos + 7 <= len(data):
+            if data[pos] != 0xFF or data[pos + 1] & 0xF0 != 0xF0:
+                pos += 1
+                continue
+            length = ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+            if length < 7:
+                pos += 1
+                continue
+            if pos + length > len(data):
+                break
+            self.sample_rate = ADTS_SAMPLE_RATES[min((data[pos + 2] >> 2) & 0x0F, 12)]
+            self.samples += 1024 * ((data[pos + 6] & 0x03) + 1)
+            pos += length
+            if self.samples >= segment_time * self.sample_rate:
+                cuts.append(self.offset + pos)
+                self.samples = 0
+        self.offset += pos
+        return cuts
+
+
+def encode_range(filename, start, end, output, timeout, profile='mp3-128k', silence=None):
+    """Encode bytes [start, end) of an ADTS file with `profile`. `end=None` means up to the end of file."""
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read() if end is None else f.read(end - start)
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+           '-f', 'aac', '-i', 'pipe:0', '-vn', *(['-af', silence] if silence else []), *PROFILES[profile]['args'], output]
+    logger.info(f'{" ".join(cmd)} < {filename}[{start}:{end}]')
+    try:
+        with FFMPEG_SECONDS.labels('live').time():
+            result = subprocess.run(cmd, input=data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TranscodeError(f'ffmpeg timed out after {timeout}s')
+    if result.returncode:
+        raise TranscodeError(f'ffmpeg exited with {result.returncode}: {result.stderr.decode(errors="replace")[-500:]}')
+
+
+class LiveEncoder:
+    """Encode a recording that is still being written, one closed segment at a time.
+
+    poll() encodes every segment that has been completely written since the last call,
+    finish() encodes whatever is left once the recorder is done.
+    """
+
+    def __init__(self, filename, directory, name, target_size, profile='mp3-128k', silence=None):
+        self.filename = str(filename)
+        self.directory = directory
+        self.name = name
+        self.profile = profile
+        self.silence = silence
+        self.segment_time = segment_time(0, PROFILES[profile]['bitrate'], target_size)
+        self.tail = AdtsTail(filename)
+        self.start = 0
+        self.parts = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def _encode(self, end, limit, timeout):
+        output = f'{self.directory}/{self.name}_{self.profile}_part_{len(self.parts):03d}.{PROFILES[self.profile]["ext"]}'
+        encode_range(self.filename, self.start, end, output, timeout, self.profile, self.silence)
+        self.parts.extend(ensure_size([output], limit, timeout))
+
+    def _drain(self, limit, timeout):
+        for end in self.tail.cuts(self.segment_time):
+            self._encode(end, limit, timeout)
+            self.start = end
+
+    def poll(self, limit, timeout):
+        with self.lock:
+            # A poll queued before finish() must not touch the parts that are being sent
+            if not self.closed:
+                self._drain(limit, timeout)
+
+    def ready(self):
+        with self.lock:
+            return list(self.parts)
+
+    def state(self):
+        """Everything needed to pick up where this encoder left off after a restart, see resume()."""
+        with self.lock:
+            return {'filename': self.filename, 'start': self.start,
+                    'offset': self.tail.offset, 'samples': self.tail.samples,
+                    'parts': [{'path': part, 'size': os.path.getsize(part)} for part in self.parts]}
+
+    def resume(self, state):
+        """Continue from the state() of an earlier encoder of the same recording."""
+        with self.lock:
+            self.tail = AdtsTail(self.filename, state['offset'], state['samples'])
+            self.start = state['start']
+            self.parts = [part['path'] for part in state['parts']]
+
+    def finish(self, limit, timeout, skip=0):
+        """Encode the rest of a finished recording. Returns every part after the first `skip`."""
+        with self.lock:
+            self.closed = True
+            self._drain(limit, timeout)
+            if self.tail.offset > self.start:
+                self._encode(None, limit, timeout)
+                self.start = self.tail.offset
+            return self.parts[skip:]